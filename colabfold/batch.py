@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import os
-ENV = {"TF_FORCE_UNIFIED_MEMORY":"1", "XLA_PYTHON_CLIENT_MEM_FRACTION":"4.0"}
+# the gpu memory is grown on demand up to the fraction instead of being taken at startup,
+# so amber on the gpu still finds memory next to jax
+ENV = {"TF_FORCE_UNIFIED_MEMORY":"1", "XLA_PYTHON_CLIENT_MEM_FRACTION":"4.0", "XLA_PYTHON_CLIENT_PREALLOCATE":"false"}
 for k,v in ENV.items():
     if k not in os.environ: os.environ[k] = v
 
@@ -20,27 +22,44 @@ import shutil
 import pickle
 import gzip
 import lzma
+import mmap
+import stat
 import uuid
 
+try:
+    import fcntl
+except ImportError:
+    # not available on windows, store entries are then written without locking
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:
+    # optional, scores and distograms are then encoded with the json module
+    orjson = None
+
 from PIL import Image
-import matplotlib.pyplot as plt
+# pyplot is only imported where a figure needs it, the module level plotting only needs the colors
 import matplotlib.colors
+from matplotlib.collections import LineCollection
 import re
 import hashlib
 from datetime import datetime, timezone
 
-from threading import Thread, Event
+from threading import Condition, Event, Lock, Thread, get_ident
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 from argparse import ArgumentParser
 from pathlib import Path
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union, TYPE_CHECKING
-from io import StringIO
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+import itertools
 
 import importlib_metadata
 import numpy as np
 import pandas
 
-import tensorflow as tf
-
 try:
     import alphafold
 except ModuleNotFoundError:
@@ -68,6 +87,8 @@ from alphafold.data import (
 from alphafold.data.tools import hhsearch
 from colabfold.citations import write_bibtex
 from colabfold.download import default_data_dir, download_alphafold_params
+from colabfold.relax import openmm_cuda_available, patch_openmm
+from colabfold.templates import parse_cif_chains
 from colabfold.utils import (
     ACCEPT_DEFAULT_TERMS,
     DEFAULT_API_SERVER,
@@ -79,7 +100,7 @@ from colabfold.utils import (
     CFMMCIFIO,
 )
 
-from Bio.PDB import MMCIFParser, PDBParser, MMCIF2Dict
+from Bio.PDB import PDBParser
 
 # logging settings
 logger = logging.getLogger(__name__)
@@ -87,6 +108,19 @@ import jax
 import jax.numpy as jnp
 logging.getLogger('jax._src.lib.xla_bridge').addFilter(lambda _: False)
 
+# --matmul-precision names to jax_default_matmul_precision values
+MATMUL_PRECISIONS = {"highest": "float32", "high": "tensorfloat32", "medium": "bfloat16"}
+
+def enable_compilation_cache(cache_dir: str):
+    # keep compiled models on disk so a new process with the same padded lengths skips the compilation.
+    # jax doesn't limit the size of the cache directory
+    try:
+        jax.config.update("jax_compilation_cache_dir", cache_dir)
+        jax.config.update("jax_persistent_cache_min_entry_size_bytes", 0)
+    except (AttributeError, KeyError):
+        # older jax versions do not have these options
+        logger.warning("This jax version has no persistent compilation cache")
+
 
 c1 = (47, 117, 214, 255)
 c1 = tuple(ti/255 for ti in c1)
@@ -97,94 +131,102 @@ c2 = tuple(ti/255 for ti in c2)
 c3 = (237, 64, 64,255)
 c3 = tuple(ti/255 for ti in c3)
 
-norm = plt.Normalize(-2,2)
+norm = matplotlib.colors.Normalize(-2,2)
 cmap = matplotlib.colors.LinearSegmentedColormap.from_list("", [c1, c2, c3])
 
-def plot_ticks(Ls, line_thickness=0.5):
-    Ln = sum(Ls)
-    L_prev = 0
-    for L_i in Ls[:-1]:
-        L = L_prev + L_i
-        L_prev += L_i
-        plt.plot([0, Ln], [L, L], color="black", linewidth=line_thickness)
-        plt.plot([L, L], [0, Ln], color="black", linewidth=line_thickness)
-    ticks = np.cumsum([0] + Ls)
-    ticks = (ticks[1:] + ticks[:-1]) / 2
-    plt.yticks(ticks)
-
+def plot_ticks(Ls, line_thickness=0.5, ax=None):
+    if ax is None:
+        import matplotlib.pyplot as plt
+        ax = plt.gca()
+    bounds = np.cumsum([0] + list(Ls))
+    Ln = bounds[-1]
+    # all chain boundaries go into a single collection instead of two line artists per chain
+    segments = [[(0, L), (Ln, L)] for L in bounds[1:-1]] + [[(L, 0), (L, Ln)] for L in bounds[1:-1]]
+    ax.add_collection(LineCollection(segments, colors="black", linewidths=line_thickness))
+    ticks = (bounds[1:] + bounds[:-1]) / 2
+    ax.set_yticks(ticks)
+
+# one figure is reused for all pae plots, drawn with the Agg canvas directly so pyplot's
+# figure manager is never involved
+pae_figure = None
+pae_figure_dpi = 150
+
+def get_pae_figure(img_size):
+    global pae_figure
+    if pae_figure is None:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        pae_figure = Figure(facecolor='w', dpi=pae_figure_dpi)
+        FigureCanvasAgg(pae_figure)
+        # the axes fill the whole figure, so there is no margin to trim
+        pae_figure.add_axes([0, 0, 1, 1])
+    pae_figure.set_size_inches(img_size / pae_figure_dpi, img_size / pae_figure_dpi)
+    return pae_figure
 
 def plot_pae(pae, pae_filename, Ls=None,img_size = 600):
 
-    fig = plt.figure(num=1, clear=True, facecolor='w')
-    width = img_size/300
-    fig.set_size_inches(width, width)
-    ax = fig.add_subplot()
+    fig = get_pae_figure(img_size)
+    ax = fig.axes[0]
+    ax.clear()
     Ln = pae.shape[0]
     ax.imshow(pae,cmap=cmap,vmin=0,vmax=30,extent=(0, Ln, Ln, 0))
     ax.axis('off')
-    if Ls is not None and len(Ls) > 1: plot_ticks(Ls)
-    plt.savefig(pae_filename, bbox_inches='tight', pad_inches = 0, dpi =300)
-    fig.clear()
-    plt.close(fig)
-    img = Image.open(pae_filename).convert("RGB");
-    img.save(pae_filename.replace("png", "webp"), "webp", lossless=True)
-    os.remove(pae_filename)
-
-def patch_openmm():
-    from simtk.openmm import app
-    from simtk.unit import nanometers, sqrt
-
-    # applied https://raw.githubusercontent.com/deepmind/alphafold/main/docker/openmm.patch
-    # to OpenMM 7.5.1 (see PR https://github.com/openmm/openmm/pull/3203)
-    # patch is licensed under CC-0
-    # OpenMM is licensed under MIT and LGPL
-    # fmt: off
-    def createDisulfideBonds(self, positions):
-        def isCyx(res):
-            names = [atom.name for atom in res._atoms]
-            return 'SG' in names and 'HG' not in names
-        # This function is used to prevent multiple di-sulfide bonds from being
-        # assigned to a given atom.
-        def isDisulfideBonded(atom):
-            for b in self._bonds:
-                if (atom in b and b[0].name == 'SG' and
-                    b[1].name == 'SG'):
-                    return True
-
-            return False
-
-        cyx = [res for res in self.residues() if res.name == 'CYS' and isCyx(res)]
-        atomNames = [[atom.name for atom in res._atoms] for res in cyx]
-        for i in range(len(cyx)):
-            sg1 = cyx[i]._atoms[atomNames[i].index('SG')]
-            pos1 = positions[sg1.index]
-            candidate_distance, candidate_atom = 0.3*nanometers, None
-            for j in range(i):
-                sg2 = cyx[j]._atoms[atomNames[j].index('SG')]
-                pos2 = positions[sg2.index]
-                delta = [x-y for (x,y) in zip(pos1, pos2)]
-                distance = sqrt(delta[0]*delta[0] + delta[1]*delta[1] + delta[2]*delta[2])
-                if distance < candidate_distance and not isDisulfideBonded(sg2):
-                    candidate_distance = distance
-                    candidate_atom = sg2
-            # Assign bond to closest pair.
-            if candidate_atom:
-                self.addBond(sg1, candidate_atom)
-    # fmt: on
-    app.Topology.createDisulfideBonds = createDisulfideBonds
-
+    if Ls is not None and len(Ls) > 1: plot_ticks(Ls, ax=ax)
+    fig.canvas.draw()
+    img = Image.frombuffer("RGBA", fig.canvas.get_width_height(), fig.canvas.buffer_rgba(), "raw", "RGBA", 0, 1).convert("RGB")
+    # lossy at high quality is indistinguishable for a heatmap and several times faster to encode than lossless
+    img.save(pae_filename.replace("png", "webp"), "webp", quality=90, method=4)
+
+def warm_up_plotting():
+    # imports the plotting modules (with the Agg backend) and loads the font cache, which takes
+    # a second or two the first time, so the msa plot of the first job doesn't wait for it
+    import colabfold.plot
+    from matplotlib import font_manager
+    font_manager.findfont(font_manager.FontProperties())
+
+# removes the lowercase insertion states of an a3m sequence line
+A3M_INSERTIONS_TABLE = str.maketrans('', '', 'abcdefghijklmnopqrstuvwxyz\n')
+
+def iter_lines(text):
+    # like text.split('\n'), but yields one line at a time instead of building a list of all of them
+    pos = 0
+    while pos < len(text):
+        line_end = text.find('\n', pos)
+        if line_end == -1:
+            yield text[pos:]
+            return
+        yield text[pos:line_end]
+        pos = line_end + 1
+
+def get_msa_query_sequence(msa_str):
+    # the query is the second line of an a3m, find it without splitting the whole msa
+    start = msa_str.find('\n') + 1
+    if start == 0:
+        return ""
+    end = msa_str.find('\n', start)
+    return msa_str[start:] if end == -1 else msa_str[start:end]
 
 def crop_msa(msa_str, start, end, drop_empty = True):
-    
+    # msa_str is the a3m content, an open a3m file or the path of one
+    if isinstance(msa_str, os.PathLike):
+        with open(msa_str) as f:
+            return crop_msa(f, start, end, drop_empty)
+    if isinstance(msa_str, str):
+        lines = iter_lines(msa_str)
+    else:
+        lines = (line.rstrip('\n') for line in msa_str)
+
     new_lines = []
     active_id = None
-    lines = msa_str.splitlines()
     for line in lines:
+        if len(line) == 0:
+            continue
         if line[0] != '>' and active_id is not None:
-            new_line = re.sub(r"[a-z\n]",'', line)[start - 1:end]
+            new_line = line.translate(A3M_INSERTIONS_TABLE)[start - 1:end]
 
             if drop_empty:
-                if len(new_line.replace('-', '')) > 0:
+                # only keep sequences that have at least one residue in the cropped region
+                if new_line.count('-') != len(new_line):
                     new_lines.append(active_id)
                     new_lines.append(new_line)
             else:
@@ -196,14 +238,209 @@ def crop_msa(msa_str, start, end, drop_empty = True):
     return "\n".join(new_lines)
 
 
+# in-process memo of template features and raw unpaired msas keyed by aa_seq_to_id,
+# shared by all jobs of a batch so a repeated chain is only loaded or fetched once
 global_template_a3m_lines_mmseqs2_storage = {}
 global_unpaired_a3m_lines_storage = {}
+global_storage_max_entries = 128
+global_storage_lock = Lock()
+
+def storage_get(storage, seq_id):
+    with global_storage_lock:
+        value = storage.pop(seq_id, None)
+        if value is not None:
+            storage[seq_id] = value
+        return value
+
+def storage_put(storage, seq_id, value):
+    with global_storage_lock:
+        storage.pop(seq_id, None)
+        storage[seq_id] = value
+        while len(storage) > global_storage_max_entries:
+            # dicts keep insertion order, so the first key is the least recently used
+            storage.pop(next(iter(storage)))
+
+@contextmanager
+def open_atomic(filename):
+    # write to a temporary file first, so a concurrent reader never sees a partially written file
+    tmp_filename = f"{filename}.{os.getpid()}.{get_ident()}.tmp"
+    try:
+        with open(tmp_filename, 'wb') as f:
+            yield f
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+def save_template_features(template_feature, filename):
+    arrays = {}
+    for k, v in template_feature.items():
+        v = np.asarray(v)
+        if v.dtype == object:
+            # names and sequences are bytes, store them as a fixed width bytes array instead of pickling
+            v = v.astype(bytes)
+        elif v.dtype == np.float64:
+            v = v.astype(np.float32)
+        arrays[k] = v
+    with open_atomic(filename) as f:
+        np.savez_compressed(f, **arrays)
+
+def load_template_features(filename):
+    template_feature = {}
+    with np.load(filename) as data:
+        for k in data.files:
+            v = data[k]
+            template_feature[k] = v.astype(object) if v.dtype.kind == 'S' else v
+    return template_feature
+
+# searches on the msa server in flight across all msa threads of this process, including concurrent
+# run() calls. the concurrently fetched jobs each run several searches and the prefetch runs next to them,
+# a search only starts while fewer than the limit of its caller are in flight
+MAX_MSA_SERVER_SEARCHES = 3
+global_msa_server_searches = 0
+global_msa_server_condition = Condition()
+
+def run_mmseqs2_throttled(*args, max_searches: int = MAX_MSA_SERVER_SEARCHES, **kwargs):
+    """run_mmseqs2 once fewer than max_searches searches of this process are in flight"""
+    from colabfold.colabfold import run_mmseqs2
+    global global_msa_server_searches
+
+    with global_msa_server_condition:
+        global_msa_server_condition.wait_for(lambda: global_msa_server_searches < max(1, max_searches))
+        global_msa_server_searches += 1
+    try:
+        return run_mmseqs2(*args, **kwargs)
+    finally:
+        with global_msa_server_condition:
+            global_msa_server_searches -= 1
+            global_msa_server_condition.notify_all()
+
+# in-process locks on store entries by file name, used when there is no store to put lock files in.
+# each entry is [lock, number of holders and waiters], it is removed when the last of them releases it
+global_entry_locks = {}
+
+def lock_store_entry(lock_filename):
+    # the holder of a lock removes its lock file before releasing it, so the stores don't keep one lock
+    # file per entry. a lock taken on a file that was removed meanwhile is retried on the new file
+    while True:
+        lock_file = open(lock_filename, 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.stat(lock_filename).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+
+@contextmanager
+def store_locks(store_dir, filenames):
+    # exclusive locks on store entries, held while they are searched and written so concurrent
+    # processes sharing a store search each chain once. taken in sorted order to avoid deadlocks.
+    # without a store the msa threads of this process still search a chain shared by their jobs once
+    lock_files = []
+    entry_locks = []
+    try:
+        if fcntl is not None and store_dir and len(filenames) > 0:
+            for filename in sorted(set(filenames)):
+                lock_files.append(lock_store_entry(os.path.join(store_dir, f'{filename}.lock')))
+        else:
+            for filename in sorted(set(filenames)):
+                with global_storage_lock:
+                    entry = global_entry_locks.setdefault(filename, [Lock(), 0])
+                    entry[1] += 1
+                entry[0].acquire()
+                entry_locks.append(filename)
+        yield
+    finally:
+        # the entries are written (or failed) at this point, the lock file is removed while it is
+        # still locked and closing the file releases the lock
+        for lock_file in lock_files:
+            try:
+                os.remove(lock_file.name)
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+        for filename in entry_locks:
+            with global_storage_lock:
+                entry = global_entry_locks[filename]
+                entry[0].release()
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del global_entry_locks[filename]
+
+def list_store(store_dir):
+    # one readdir answers the existence checks of all chains, instead of one stat per file
+    try:
+        return set(os.listdir(store_dir))
+    except FileNotFoundError:
+        return set()
+
+def load_stored_template_features(store_dir, seq_id, existing=None):
+    if existing is None: existing = list_store(store_dir)
+    if f'{seq_id}.npz' in existing:
+        return load_template_features(os.path.join(store_dir, f'{seq_id}.npz'))
+    # stores written by older versions
+    filename = os.path.join(store_dir, f'{seq_id}.pkl')
+    if f'{seq_id}.pkl' in existing:
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    return None
+
+def save_unpaired_msa(msa_str, filename):
+    # a3m text compresses very well, a low level keeps writes cheap
+    with open_atomic(filename) as f:
+        with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=3) as gz:
+            gz.write(msa_str.encode('ascii'))
+
+def load_stored_unpaired_msa(store_dir, seq_id, existing=None):
+    if existing is None: existing = list_store(store_dir)
+    if f'{seq_id}.a3m.gz' in existing:
+        with gzip.open(os.path.join(store_dir, f'{seq_id}.a3m.gz'), 'rb') as f:
+            return f.read().decode('ascii')
+    # stores written by older versions
+    filename = os.path.join(store_dir, f'{seq_id}.pkl')
+    if f'{seq_id}.pkl' in existing and os.path.getsize(filename) > 100:
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    return None
+
+JOBNAME_SPLIT_RE = re.compile(r'[^0-9]-[^0-9]|__')
+# the region is the part between the first and second dot of a chain name, e.g. DPOLQ_HUMAN.1-500.
+CHAIN_REGION_RE = re.compile(r'^[^.]*\.(\d+)-(\d+)(?:\.|$)')
+
+@lru_cache(maxsize=1024)
+def parse_chain_regions(jobname, seq_lengths):
+    """Parse the 1-based [start, end] crop of every chain from the jobname,
+    [1, -1] means the chain is not cropped. Returns (valid_name, chain_regions)."""
+    comps = JOBNAME_SPLIT_RE.split(jobname)
+    if len(comps) - 1 != len(seq_lengths):
+        return False, ()
+    chain_regions = []
+    for c, seq_len in zip(comps, seq_lengths):
+        if '-' in c and '.' in c:
+            m = CHAIN_REGION_RE.match(c)
+            if m is None:
+                return False, ()
+            start, end = int(m.group(1)), int(m.group(2))
+            if start < 1 or end < start or end > seq_len:
+                return False, ()
+            chain_regions.append((start, end))
+        else:
+            chain_regions.append((1, -1))
+    return True, tuple(chain_regions)
+
+def map_concurrently(fn, items, max_workers=16):
+    # the store lookups are blocking file system calls, on a network file system running them
+    # concurrently costs about one round trip instead of one per chain
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(fn, items))
 
 def aa_seq_to_id(sequence):
-    sequence_bytes = sequence.encode('utf-8')
-    md5_hash = hashlib.md5(sequence_bytes).hexdigest()
-    identifier = ''.join(c for c in md5_hash if c.isalnum())
-    return identifier
+    # hexdigest is already alphanumeric, keep md5 so existing stores stay valid
+    return hashlib.md5(sequence.encode('ascii')).hexdigest()
 
 
 
@@ -220,38 +457,14 @@ def get_msa_and_templates_v2(
 ) -> Tuple[
     Optional[List[str]], Optional[List[str]], List[str], List[int], List[Dict[str, Any]]
 ]:
-    from colabfold.colabfold import run_mmseqs2
-
     use_env = msa_mode == "mmseqs2_uniref_env"
     if isinstance(query_sequences, str): query_sequences = [query_sequences]
 
     #DPOLQ_HUMAN.1-500.__MSH3_HUMAN__1637aa
-    comps = re.split('[^0-9]\-[^0-9]|__', jobname)
-    chain_regions = []
-    valid_name = len(comps) - 1 == len(query_sequences)
-    if valid_name:
-        for i in range(0, len(comps) - 1):
-            c = comps[i]
-            if '-' and '.' in c:
-                r = c.split('.')[1]
-                if len(r.split('-')) != 2:
-                    valid_name = False
-                    break
-                start, end = r.split('-')
-                start = int(start)
-                end = int(end)
-                if (start < 1 or end < start or end > len(query_sequences[i])):
-                    valid_name = False
-                chain_regions.append([int(start),int(end)])
-            else:
-                chain_regions.append([1,-1])
+    valid_name, chain_regions = parse_chain_regions(jobname, tuple(len(seq) for seq in query_sequences))
 
-
-    if not os.path.exists('colabfold_template_store'):
-        os.makedirs('colabfold_template_store')
-
-    if not os.path.exists('colabfold_unpaired_msa_store'):
-        os.makedirs('colabfold_unpaired_msa_store')
+    Path('colabfold_template_store').mkdir(parents=True, exist_ok=True)
+    Path('colabfold_unpaired_msa_store').mkdir(parents=True, exist_ok=True)
 
 
     query_seqs_unique = []
@@ -262,33 +475,35 @@ def get_msa_and_templates_v2(
     query_seqs_cardinality = [1] * len(query_seqs_unique)
 
     # get template features
-    template_features = {}
+    template_features = [None] * len(query_seqs_unique)
     if use_templates:
 
-        seqs_to_fetch = []
-        indices_fetched = []
-
-        for index in range(0, len(query_seqs_unique)):
-            msa_seq = query_seqs_unique[index]
-            actual_seq = msa_seq
+        stored_template_files = list_store('colabfold_template_store')
+        def lookup_template_features(index):
+            actual_seq = query_seqs_unique[index]
             if valid_name and chain_regions[index][1] != -1:
                 actual_seq = query_seqs_unique[index][chain_regions[index][0] - 1:chain_regions[index][1]]
 
-            stored_feature = None
             id = aa_seq_to_id(actual_seq)
-            stored_templates_filename = f'colabfold_template_store/{id}.pkl'
-            if os.path.isfile(stored_templates_filename) and (time.time() - os.path.getmtime(stored_templates_filename)) > 20:
-                with open(stored_templates_filename, 'rb') as f:
-                    stored_feature = pickle.load(f)
-
-            template_features[index] = stored_feature
+            stored_feature = storage_get(global_template_a3m_lines_mmseqs2_storage, id)
             if stored_feature is None:
-                seqs_to_fetch.append(msa_seq)
+                stored_feature = load_stored_template_features('colabfold_template_store', id, stored_template_files)
+                if stored_feature is not None:
+                    storage_put(global_template_a3m_lines_mmseqs2_storage, id, stored_feature)
+            return stored_feature
+
+        template_features = map_concurrently(lookup_template_features, range(len(query_seqs_unique)))
+
+        seqs_to_fetch = []
+        indices_fetched = []
+        for index in range(0, len(query_seqs_unique)):
+            if template_features[index] is None:
+                seqs_to_fetch.append(query_seqs_unique[index])
                 indices_fetched.append(index)
 
         if len(seqs_to_fetch) > 0:
 
-            a3m_lines_mmseqs2, template_paths = run_mmseqs2(
+            a3m_lines_mmseqs2, template_paths = run_mmseqs2_throttled(
                 seqs_to_fetch,
                 str(result_dir.joinpath(jobname)),
                 use_env,
@@ -305,9 +520,7 @@ def get_msa_and_templates_v2(
                             template_paths[i] = None
                     
             if custom_template_path is not None:
-                template_paths = {}
-                for index in range(0, len(query_seqs_unique)):
-                    template_paths[index] = custom_template_path
+                template_paths = [custom_template_path] * len(seqs_to_fetch)
             if template_paths is None:
                 logger.info("No template detected")
                 for i, index in enumerate(indices_fetched):
@@ -316,8 +529,8 @@ def get_msa_and_templates_v2(
                     template_features[index] = template_feature
                     id = aa_seq_to_id(seq)
                     logger.info(f"Writing out empty template with ID: {id} for seq: {seq}")
-                    with open(f'colabfold_template_store/{id}.pkl', 'wb') as f:
-                        pickle.dump(template_feature, f)
+                    storage_put(global_template_a3m_lines_mmseqs2_storage, id, template_feature)
+                    save_template_features(template_feature, f'colabfold_template_store/{id}.npz')
 
             else:
 
@@ -329,9 +542,10 @@ def get_msa_and_templates_v2(
 
                     if template_paths[i] is not None:
                         logger.info(f"Generating new template")
-                        lines = a3m_lines_mmseqs2[i].splitlines()
-                        logger.info(f"TEMPLATE MSA LINE 0: {lines[0]}")
-                        logger.info(f"TEMPLATE MSA LINE 1: {lines[1]}")
+                        # only the first two lines are logged, don't split the whole msa for them
+                        lines = a3m_lines_mmseqs2[i].split('\n', 2)
+                        logger.info("TEMPLATE MSA LINE 0: %s", lines[0])
+                        logger.info("TEMPLATE MSA LINE 1: %s", lines[1] if len(lines) > 1 else "")
                         
                         template_feature = mk_template(a3m_lines_mmseqs2[i],template_paths[i],seq)
 
@@ -339,15 +553,15 @@ def get_msa_and_templates_v2(
                             template_feature = mk_mock_template(seq)
                             logger.info(f"Sequence {index} found no templates")
                         else:
-                            logger.info(f"Sequence {index} found templates: {template_feature['template_domain_names'].astype(str).tolist()}")
+                            log_found_templates(index, template_feature["template_domain_names"])
                     else:
                         template_feature = mk_mock_template(seq)
                         logger.info(f"Sequence {index} found no templates")
 
                     template_features[index] = template_feature
                     id = aa_seq_to_id(seq)
-                    with open(f'colabfold_template_store/{id}.pkl', 'wb') as f:
-                        pickle.dump(template_feature, f)
+                    storage_put(global_template_a3m_lines_mmseqs2_storage, id, template_feature)
+                    save_template_features(template_feature, f'colabfold_template_store/{id}.npz')
 
         else:
             logger.info("No need to fetch templates, already have finished features ready!")
@@ -359,13 +573,6 @@ def get_msa_and_templates_v2(
                 seq = query_seqs_unique[index][chain_regions[index][0] - 1:chain_regions[index][1]]
             template_feature = mk_mock_template(seq)
             template_features[index] = template_feature
-    
-    final_template_features = []
-    for index in range(0, len(query_seqs_unique)):
-        final_template_features.append(template_features[index])
-
-    template_features = final_template_features
-    # template_features = list(template_features.values())
 
     if len(query_sequences) == 1:
         pair_mode = "none"
@@ -375,31 +582,35 @@ def get_msa_and_templates_v2(
             a3m_lines = []
             num = 101
             for i, seq in enumerate(query_seqs_unique):
-                if valid_name and chain_regions[index][1] != -1:
-                    seq = query_seqs_unique[index][chain_regions[index][0] - 1:chain_regions[index][1]]
+                if valid_name and chain_regions[i][1] != -1:
+                    seq = seq[chain_regions[i][0] - 1:chain_regions[i][1]]
                 a3m_lines.append(f">{num + i}\n{seq}")
         else:
             # find normal a3ms
-            unpaired_msa_lines = {}
+            stored_msa_files = list_store('colabfold_unpaired_msa_store')
+            def lookup_unpaired_msa(seq):
+                id = aa_seq_to_id(seq)
+                stored_msa = storage_get(global_unpaired_a3m_lines_storage, id)
+                if stored_msa is None:
+                    stored_msa = load_stored_unpaired_msa('colabfold_unpaired_msa_store', id, stored_msa_files)
+                    if stored_msa is not None:
+                        logger.info(f"Used {id} for an unpaired msa")
+                        if get_msa_query_sequence(stored_msa) != seq:
+                            logger.info(f"Unpaired MSA contained a mismatch, will get correct sequence now")
+                            stored_msa = None
+                        else:
+                            storage_put(global_unpaired_a3m_lines_storage, id, stored_msa)
+                return stored_msa
+
+            stored_msas = map_concurrently(lookup_unpaired_msa, query_seqs_unique)
+            unpaired_msa_lines = [None] * len(query_seqs_unique)
 
             seqs_to_fetch = []
             indices_fetched = []
 
             for index in range(0, len(query_seqs_unique)):
                 seq = query_seqs_unique[index]
-
-                stored_msa = None
-                id = aa_seq_to_id(seq)
-                stored_msa_filename = f'colabfold_unpaired_msa_store/{id}.pkl'
-                if os.path.isfile(stored_msa_filename) and os.path.getsize(stored_msa_filename) > 100 and (time.time() - os.path.getmtime(stored_msa_filename)) > 20:
-                    logger.info(f"Used {id} for an unpaired msa")
-                    with open(stored_msa_filename, 'rb') as f:
-                        stored_msa = pickle.load(f)
-                    
-                    if stored_msa.splitlines()[1] != seq:
-                        logger.info(f"Unpaired MSA contained a mismatch, will get correct sequence now")
-                        stored_msa = None
-
+                stored_msa = stored_msas[index]
                 if stored_msa is not None:
                     msa_str = stored_msa
                     if valid_name and chain_regions[index][1] != -1:
@@ -412,7 +623,7 @@ def get_msa_and_templates_v2(
             if len(seqs_to_fetch) > 0:
  
                 logger.info(f"Fetching unpaired MSAs for sequences:{seqs_to_fetch}")
-                newly_fetched_a3ms = run_mmseqs2(
+                newly_fetched_a3ms = run_mmseqs2_throttled(
                     seqs_to_fetch,
                     str(result_dir.joinpath(jobname)),
                     use_env,
@@ -425,10 +636,10 @@ def get_msa_and_templates_v2(
                     logger.info(f"Working on seq:{seq}")
                     id = aa_seq_to_id(seq)
                     logger.info(f"Seq hash id is:{id}")
-                    stored_msa_filename = f"colabfold_unpaired_msa_store/{id}.pkl"
-                    with open(stored_msa_filename, 'wb') as f:
-                        logger.info(f"writing out new unpaired MSA with ID:{id}")
-                        pickle.dump(newly_fetched_a3ms[i], f)
+                    stored_msa_filename = f"colabfold_unpaired_msa_store/{id}.a3m.gz"
+                    logger.info(f"writing out new unpaired MSA with ID:{id}")
+                    storage_put(global_unpaired_a3m_lines_storage, id, newly_fetched_a3ms[i])
+                    save_unpaired_msa(newly_fetched_a3ms[i], stored_msa_filename)
 
                     msa_str = newly_fetched_a3ms[i]
                     if valid_name and chain_regions[index][1] != -1:
@@ -437,19 +648,9 @@ def get_msa_and_templates_v2(
                         msa_str = crop_msa(msa_str, region[0], region[1])
                     
                     unpaired_msa_lines[index] = msa_str
-                
-                final_lines = []
-                for index in range(0, len(query_seqs_unique)):
-                    final_lines.append(unpaired_msa_lines[index])
-                a3m_lines = final_lines
-                # a3m_lines = list(unpaired_msa_lines.values())
             else:
                 logger.info("No need to fetch unpaired MSAs, already have finished MSAs ready!")
-                final_lines = []
-                for index in range(0, len(query_seqs_unique)):
-                    final_lines.append(unpaired_msa_lines[index])
-                a3m_lines = final_lines
-                # a3m_lines = list(unpaired_msa_lines.values())
+            a3m_lines = unpaired_msa_lines
 
     else:
         a3m_lines = None
@@ -457,7 +658,7 @@ def get_msa_and_templates_v2(
     if msa_mode != "single_sequence" and ( pair_mode == "paired" or pair_mode == "unpaired_paired"):
         # find paired a3m if not a homooligomers
         if len(query_seqs_unique) > 1:
-            paired_a3m_lines = run_mmseqs2(
+            paired_a3m_lines = run_mmseqs2_throttled(
                 query_seqs_unique,
                 str(result_dir.joinpath(jobname)),
                 use_env,
@@ -500,6 +701,187 @@ def get_msa_and_templates_v2(
 
 
 
+def put_template_features(store_dir: Optional[str], seq: str, template_feature: Dict[str, Any]):
+    """puts fetched template features into the in-process memo and, when set, the store shared with other runs"""
+    seq_id = aa_seq_to_id(seq)
+    storage_put(global_template_a3m_lines_mmseqs2_storage, seq_id, template_feature)
+    if store_dir:
+        save_template_features(template_feature, os.path.join(store_dir, f'{seq_id}.npz'))
+
+def put_unpaired_msa(store_dir: Optional[str], seq: str, msa_str: str):
+    """puts a fetched unpaired msa into the in-process memo and, when set, the store shared with other runs"""
+    seq_id = aa_seq_to_id(seq)
+    storage_put(global_unpaired_a3m_lines_storage, seq_id, msa_str)
+    if store_dir:
+        save_unpaired_msa(msa_str, os.path.join(store_dir, f'{seq_id}.a3m.gz'))
+
+def make_template_features(
+    seqs: List[str],
+    a3m_lines_mmseqs2: List[str],
+    template_paths: Optional[List[Optional[str]]],
+    custom_template_path: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """template features of every sequence of a template search, mock templates where nothing was found"""
+    if custom_template_path is not None:
+        template_paths = [custom_template_path] * len(seqs)
+    if template_paths is None:
+        logger.info("No template detected")
+        return [mk_mock_template(seq) for seq in seqs]
+    template_features = []
+    for seq_ix, seq in enumerate(seqs):
+        if template_paths[seq_ix] is not None:
+            template_feature = mk_template(a3m_lines_mmseqs2[seq_ix], template_paths[seq_ix], seq)
+            if len(template_feature["template_domain_names"]) == 0:
+                template_feature = mk_mock_template(seq)
+                logger.info(f"Sequence {seq_ix} found no templates")
+            else:
+                log_found_templates(seq_ix, template_feature["template_domain_names"])
+        else:
+            template_feature = mk_mock_template(seq)
+            logger.info(f"Sequence {seq_ix} found no templates")
+        template_features.append(template_feature)
+    return template_features
+
+# sequences per batched MMseqs2 request of the msa prefetch. the first batch is small, so the
+# first job doesn't wait for a large search
+MSA_PREFETCH_FIRST_BATCH_SIZE = 8
+MSA_PREFETCH_BATCH_SIZE = 64
+
+def missing_from_stores(
+    seqs: List[str],
+    use_templates: bool,
+    saved_template_features_folder: Optional[str],
+    saved_unpaired_msa_features_folder: Optional[str],
+) -> List[str]:
+    """the sequences whose unpaired msa (or templates) are neither in the memo nor in the stores"""
+    template_files = list_store(saved_template_features_folder) if saved_template_features_folder else set()
+    msa_files = list_store(saved_unpaired_msa_features_folder) if saved_unpaired_msa_features_folder else set()
+
+    def is_missing(seq):
+        seq_id = aa_seq_to_id(seq)
+        if use_templates and storage_get(global_template_a3m_lines_mmseqs2_storage, seq_id) is None \
+                and not {f'{seq_id}.npz', f'{seq_id}.pkl'} & template_files:
+            return True
+        return storage_get(global_unpaired_a3m_lines_storage, seq_id) is None \
+            and not {f'{seq_id}.a3m.gz', f'{seq_id}.pkl'} & msa_files
+
+    return [seq for seq in seqs if is_missing(seq)]
+
+def plan_msa_prefetch(
+    queries: List[Union[str, List[str]]],
+    msa_mode: str,
+    use_templates: bool,
+    pair_mode: str,
+    saved_template_features_folder: str = None,
+    saved_unpaired_msa_features_folder: str = None,
+    first_batch_size: int = MSA_PREFETCH_FIRST_BATCH_SIZE,
+    batch_size: int = MSA_PREFETCH_BATCH_SIZE,
+) -> List[List[str]]:
+    """Splits the chains of many queries, whose unpaired msas (and templates) are missing, into batches
+    that are each searched in one MMseqs2 request by prefetch_msa_batch instead of one request per query.
+    The chains keep the order of the queries, so the first jobs only wait for the first batches.
+    Only plans batches with stores, without them the results would only live in the small in-process memo."""
+    if msa_mode == "single_sequence" or not saved_unpaired_msa_features_folder \
+            or (use_templates and not saved_template_features_folder):
+        return []
+
+    # the chains that get_msa_and_templates_v3 would search an unpaired msa or templates for
+    seqs = []
+    for query_sequences in queries:
+        if isinstance(query_sequences, str): query_sequences = [query_sequences]
+        use_unpaired_msa = len(query_sequences) == 1 or pair_mode in ("none", "unpaired", "unpaired_paired")
+        if use_unpaired_msa or use_templates:
+            seqs.extend(query_sequences)
+    seqs = missing_from_stores(
+        list(dict.fromkeys(seqs)), use_templates, saved_template_features_folder, saved_unpaired_msa_features_folder
+    )
+    if len(seqs) < 2:
+        return []
+
+    batches = [seqs[:first_batch_size]]
+    for batch_start in range(first_batch_size, len(seqs), batch_size):
+        batches.append(seqs[batch_start:batch_start + batch_size])
+    return batches
+
+def prefetch_msa_batch(
+    batch: List[str],
+    result_dir: Path,
+    msa_mode: str,
+    use_templates: bool,
+    custom_template_path: str,
+    host_url: str = DEFAULT_API_SERVER,
+    saved_template_features_folder: str = None,
+    saved_unpaired_msa_features_folder: str = None,
+    max_msa_server_searches: int = MAX_MSA_SERVER_SEARCHES,
+):
+    """Searches the unpaired msas (and templates) of a batch of plan_msa_prefetch in one MMseqs2 request and
+    puts the results into the memo and the stores, where get_msa_and_templates_v3 finds them.
+    The store entries are not locked during the search, so other processes are never stalled by a batch,
+    at worst they search a chain once more. Errors are only logged, the chains are then searched per job."""
+    try:
+        # another process may have stored some of the entries in the meantime
+        batch = missing_from_stores(batch, use_templates, saved_template_features_folder, saved_unpaired_msa_features_folder)
+        if len(batch) == 0:
+            return
+        for store_dir in (saved_template_features_folder, saved_unpaired_msa_features_folder):
+            if store_dir: Path(store_dir).mkdir(parents=True, exist_ok=True)
+        logger.info(f"Searching {len(batch)} sequences in one batch")
+        use_env = msa_mode == "mmseqs2_uniref_env"
+        # the search directory is named by its content, run_mmseqs2 reuses a downloaded result in it
+        batch_id = aa_seq_to_id("\n".join(batch))
+        prefix = str(result_dir.joinpath(f"batch_{batch_id}"))
+        if use_templates:
+            a3m_lines_mmseqs2, template_paths = run_mmseqs2_throttled(
+                batch, prefix, use_env, use_templates=True, host_url=host_url,
+                max_searches=max_msa_server_searches,
+            )
+            new_template_features = make_template_features(
+                batch, a3m_lines_mmseqs2, template_paths, custom_template_path
+            )
+            for seq, template_feature in zip(batch, new_template_features):
+                put_template_features(saved_template_features_folder, seq, template_feature)
+        else:
+            a3m_lines_mmseqs2 = run_mmseqs2_throttled(
+                batch, prefix, use_env, use_pairing=False, host_url=host_url,
+                max_searches=max_msa_server_searches,
+            )
+        # the template search returns the unpaired msas of its queries as well
+        for seq, msa_str in zip(batch, a3m_lines_mmseqs2):
+            put_unpaired_msa(saved_unpaired_msa_features_folder, seq, msa_str)
+    except Exception as e:
+        logger.warning(f"Batched MSA search failed, its queries are searched one by one: {e}")
+
+def submit_after(executor: ThreadPoolExecutor, futures, fn, *args) -> Future:
+    """Submits fn to the executor once all futures are done, so no worker of the executor is blocked
+    waiting for them. The returned future gets the result of fn."""
+    futures = set(futures)
+    if len(futures) == 0:
+        return executor.submit(fn, *args)
+    result = Future()
+    remaining = [len(futures)]
+    remaining_lock = Lock()
+
+    def copy_result(inner):
+        if inner.exception() is not None:
+            result.set_exception(inner.exception())
+        else:
+            result.set_result(inner.result())
+
+    def submit(_):
+        with remaining_lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        try:
+            executor.submit(fn, *args).add_done_callback(copy_result)
+        except RuntimeError as e:
+            # the executor was shut down
+            result.set_exception(e)
+
+    for future in futures:
+        future.add_done_callback(submit)
+    return result
+
 def get_msa_and_templates_v3(
     jobname: str,
     query_sequences: Union[str, List[str]],
@@ -511,209 +893,228 @@ def get_msa_and_templates_v3(
     host_url: str = DEFAULT_API_SERVER,
     saved_template_features_folder:str = None,
     saved_unpaired_msa_features_folder:str = None,
+    n_parallel_msa: int = 3,
+    max_msa_server_searches: int = MAX_MSA_SERVER_SEARCHES,
 ) -> Tuple[
     Optional[List[str]], Optional[List[str]], List[str], List[int], List[Dict[str, Any]]
 ]:
-    from colabfold.colabfold import run_mmseqs2
-
     use_env = msa_mode == "mmseqs2_uniref_env"
     if isinstance(query_sequences, str): query_sequences = [query_sequences]
 
-    # remove duplicates before searching
-    query_seqs_unique = []
-    for x in query_sequences:
-        if x not in query_seqs_unique:
-            query_seqs_unique.append(x)
+    # remove duplicates before searching (dict keys keep the first-seen order)
+    query_seqs_unique = list(dict.fromkeys(query_sequences))
 
     # determine how many times is each sequence is used
+    seq_to_index = {seq: index for index, seq in enumerate(query_seqs_unique)}
     query_seqs_cardinality = [0] * len(query_seqs_unique)
     for seq in query_sequences:
-        seq_idx = query_seqs_unique.index(seq)
-        query_seqs_cardinality[seq_idx] += 1
+        query_seqs_cardinality[seq_to_index[seq]] += 1
+
+    if len(query_sequences) == 1:
+        pair_mode = "none"
+
+    prefix = str(result_dir.joinpath(jobname))
+    use_unpaired_msa = pair_mode == "none" or pair_mode == "unpaired" or pair_mode == "unpaired_paired"
+    use_paired_msa = msa_mode != "single_sequence" and (
+        pair_mode == "paired" or pair_mode == "unpaired_paired"
+    ) and len(query_seqs_unique) > 1
+
+    # fetched features and msas go to the in-process memo and, when set, to the stores shared with other runs
+    for store_dir in (saved_template_features_folder, saved_unpaired_msa_features_folder):
+        if store_dir: Path(store_dir).mkdir(parents=True, exist_ok=True)
 
     #-------------------------------------------------------------------------------------------------------------------
     #-------------------------------------------------------------------------------------------------------------------
-    #TEMPLATES FETCH-------------------------------------------------------------------------------------------------
-    template_features = {}
+    #CACHE LOOKUP-------------------------------------------------------------------------------------------------------
+    template_features = [None] * len(query_seqs_unique)
+    template_seqs_to_search = []
+    search_ix_to_template_ix = []
     if use_templates:
 
-        if(saved_template_features_folder):
+        saved_template_files = list_store(saved_template_features_folder) if saved_template_features_folder else set()
+        def lookup_template_features(index):
+            seq = query_seqs_unique[index]
+            seq_id = aa_seq_to_id(seq)
+            store_template_features = storage_get(global_template_a3m_lines_mmseqs2_storage, seq_id)
+            if store_template_features is not None:
+                return store_template_features
+
+            if(saved_template_features_folder):
+                store_template_features = load_stored_template_features(saved_template_features_folder, seq_id, saved_template_files)
+                if store_template_features is not None:
+                    if 'template_aatype' in store_template_features and store_template_features['template_aatype'][0].shape[0] == len(seq):
+                        #double check that this is correct sequence via length
+                        storage_put(global_template_a3m_lines_mmseqs2_storage, seq_id, store_template_features)
+                        logger.info(f"Retreived sequence {index}: {seq} from template store {saved_template_features_folder}")
+                        return store_template_features
+            return None
+
+        template_features = map_concurrently(lookup_template_features, range(len(query_seqs_unique)))
 
-            for index in range(0, len(query_seqs_unique)):
-                seq = query_seqs_unique[index]
-                seq_id = aa_seq_to_id(seq)
-                file_path = os.path.join(saved_template_features_folder, f'{seq_id}.pkl')
-                if os.path.isfile(file_path):
-                    with open(file_path, 'rb') as f:
-                        store_template_features = pickle.load(f)
-                        if 'template_aatype' in store_template_features and store_template_features['template_aatype'][0].shape[0] == len(seq):
-                            #double check that this is correct sequence via length
-                            template_features[index] = store_template_features
-                            logger.info(f"Retreived sequence {index}: {seq} from template file {file_path}")
-
-        search_ix_to_template_ix = {}
-        seqs_to_search = []
-        search_ix = 0
         for index in range(0, len(query_seqs_unique)):
-            if(index in template_features): continue
-
-            seqs_to_search.append(query_seqs_unique[index])
-            search_ix_to_template_ix[search_ix] = index
-            search_ix += 1
-
-        if len(seqs_to_search) > 0:
-            try:
-                a3m_lines_mmseqs2, template_paths = run_mmseqs2(
-                    seqs_to_search,
-                    str(result_dir.joinpath(jobname)),
-                    use_env,
-                    use_templates=True,
-                    host_url=host_url,
-                )
-            except:
-                return None
-                
-            if custom_template_path is not None:
-                template_paths = {}
-                for seq_ix in range(0, len(seqs_to_search)):
-                    template_paths[seq_ix] = custom_template_path
-            if template_paths is None:
-                logger.info("No template detected")
-                for seq_ix in range(0, len(seqs_to_search)):
-                    template_feature = mk_mock_template(seqs_to_search[seq_ix])
-                    template_ix = search_ix_to_template_ix[seq_ix]
+            if template_features[index] is not None: continue
+            search_ix_to_template_ix.append(index)
+            template_seqs_to_search.append(query_seqs_unique[index])
 
-                    template_features[template_ix] = template_feature
-            else:
-                for seq_ix in range(0, len(seqs_to_search)):
-                    if template_paths[seq_ix] is not None:
-                        template_feature = mk_template(
-                            a3m_lines_mmseqs2[seq_ix],
-                            template_paths[seq_ix],
-                            seqs_to_search[seq_ix],
-                        )
-                        if len(template_feature["template_domain_names"]) == 0:
-                            template_feature = mk_mock_template(seqs_to_search[seq_ix])
-                            logger.info(f"Sequence {seq_ix} found no templates")
-                        else:
-                            logger.info(
-                                f"Sequence {seq_ix} found templates: {template_feature['template_domain_names'].astype(str).tolist()}"
-                            )
-                    else:
-                        template_feature = mk_mock_template(seqs_to_search[seq_ix])
-                        logger.info(f"Sequence {seq_ix} found no templates")
+    a3m_lines = [None] * len(query_seqs_unique)
+    unpaired_seqs_to_search = []
+    search_ix_to_msa_ix = []
+    if use_unpaired_msa and msa_mode != "single_sequence":
 
-                    template_ix = search_ix_to_template_ix[seq_ix]
-                    template_features[template_ix] = template_feature
-    else:
-        for index in range(0, len(query_seqs_unique)):
-            template_feature = mk_mock_template(query_seqs_unique[index])
-            template_features[index] = template_feature
+        saved_msa_files = list_store(saved_unpaired_msa_features_folder) if saved_unpaired_msa_features_folder else set()
+        def lookup_unpaired_msa(index):
+            seq = query_seqs_unique[index]
+            seq_id = aa_seq_to_id(seq)
+            saved_msa_str = storage_get(global_unpaired_a3m_lines_storage, seq_id)
+            if saved_msa_str is not None:
+                return saved_msa_str
 
-    final_template_features = [template_features[ix] for ix in range(0, len(query_seqs_unique))]
-    template_features = final_template_features
+            if(saved_unpaired_msa_features_folder):
+                saved_msa_str = load_stored_unpaired_msa(saved_unpaired_msa_features_folder, seq_id, saved_msa_files)
+                if saved_msa_str is not None:
+                    if(seq == get_msa_query_sequence(saved_msa_str)):
+                        storage_put(global_unpaired_a3m_lines_storage, seq_id, saved_msa_str)
+                        logger.info(f"Retreived unpaired MSA sequence {index}: {seq} from msa store {saved_unpaired_msa_features_folder}")
+                        return saved_msa_str
+            return None
 
-    if len(query_sequences) == 1:
-        pair_mode = "none"
+        a3m_lines = map_concurrently(lookup_unpaired_msa, range(len(query_seqs_unique)))
 
+        for index in range(0, len(query_seqs_unique)):
+            if a3m_lines[index] is not None: continue
+            search_ix_to_msa_ix.append(index)
+            unpaired_seqs_to_search.append(query_seqs_unique[index])
 
     #-------------------------------------------------------------------------------------------------------------------
     #-------------------------------------------------------------------------------------------------------------------
-    #UNPAIRED MSA FETCH-------------------------------------------------------------------------------------------------
-
-
-
-
-    if pair_mode == "none" or pair_mode == "unpaired" or pair_mode == "unpaired_paired":
-        if msa_mode == "single_sequence":
-            a3m_lines = []
-            num = 101
-            for i, seq in enumerate(query_seqs_unique):
-                a3m_lines.append(f">{num + i}\n{seq}")
-        else:
-
-            a3m_lines = {}
-            seqs_to_search = []
-            
-
-            if(saved_unpaired_msa_features_folder):
-                for index in range(0, len(query_seqs_unique)):
-                    seq = query_seqs_unique[index]
-                    seq_id = aa_seq_to_id(seq)
-                    file_path = os.path.join(saved_unpaired_msa_features_folder, f'{seq_id}.pkl')
-                    if os.path.isfile(file_path):
-                        with open(file_path, 'rb') as f:
-                            saved_msa_str = pickle.load(f)
-                            saved_msa_lines = saved_msa_str.split('\n')
-                            msa_seq = saved_msa_lines[1]
-                            if(seq == msa_seq):
-                                a3m_lines[index] = saved_msa_str
-                                logger.info(f"Retreived unpaired MSA sequence {index}: {seq} from template file {file_path}")
-
+    #MMSEQS2 SEARCHES---------------------------------------------------------------------------------------------------
+    # the template, unpaired and paired searches are independent server round-trips, submit them all at once
+    with store_locks(saved_template_features_folder, [f'{aa_seq_to_id(seq)}.npz' for seq in template_seqs_to_search]), \
+         store_locks(saved_unpaired_msa_features_folder, [f'{aa_seq_to_id(seq)}.a3m.gz' for seq in unpaired_seqs_to_search]), \
+         ThreadPoolExecutor(max_workers=max(1, n_parallel_msa)) as executor:
+
+        # another process or job may have stored some of the entries while we waited for their locks
+        if len(template_seqs_to_search) > 0:
+            saved_template_files = list_store(saved_template_features_folder) if saved_template_features_folder else set()
+            for index in search_ix_to_template_ix:
+                template_features[index] = lookup_template_features(index)
+            search_ix_to_template_ix = [index for index in search_ix_to_template_ix if template_features[index] is None]
+            template_seqs_to_search = [query_seqs_unique[index] for index in search_ix_to_template_ix]
+        if len(unpaired_seqs_to_search) > 0:
+            saved_msa_files = list_store(saved_unpaired_msa_features_folder) if saved_unpaired_msa_features_folder else set()
+            for index in search_ix_to_msa_ix:
+                a3m_lines[index] = lookup_unpaired_msa(index)
+            search_ix_to_msa_ix = [index for index in search_ix_to_msa_ix if a3m_lines[index] is None]
+            unpaired_seqs_to_search = [query_seqs_unique[index] for index in search_ix_to_msa_ix]
+
+        templates_future = None
+        if len(template_seqs_to_search) > 0:
+            templates_future = executor.submit(
+                run_mmseqs2_throttled,
+                template_seqs_to_search,
+                prefix,
+                use_env,
+                use_templates=True,
+                host_url=host_url,
+                max_searches=max_msa_server_searches,
+            )
 
-            
-            search_ix_to_msa_ix = {}
-            seqs_to_search = []
-            search_ix = 0
-            for index in range(0, len(query_seqs_unique)):
-                if(index in a3m_lines): continue
-                seqs_to_search.append(query_seqs_unique[index])
-                search_ix_to_msa_ix[search_ix] = index
-                search_ix += 1
+        # the template search returns the unpaired msas of its queries, only search again if the queries differ.
+        # a concurrent search in the same directory would clobber the template search results
+        unpaired_future = None
+        if len(unpaired_seqs_to_search) > 0 and (
+            templates_future is None or unpaired_seqs_to_search != template_seqs_to_search
+        ):
+            unpaired_future = executor.submit(
+                run_mmseqs2_throttled,
+                unpaired_seqs_to_search,
+                prefix if templates_future is None else f"{prefix}_unpaired",
+                use_env,
+                use_pairing=False,
+                host_url=host_url,
+                max_searches=max_msa_server_searches,
+            )
 
-            if len(seqs_to_search) > 0:
-                # find normal a3ms
+        paired_future = None
+        if use_paired_msa:
+            paired_future = executor.submit(
+                run_mmseqs2_throttled,
+                query_seqs_unique,
+                prefix,
+                use_env,
+                use_pairing=True,
+                host_url=host_url,
+                max_searches=max_msa_server_searches,
+            )
 
+        #-------------------------------------------------------------------------------------------------------------------
+        #-------------------------------------------------------------------------------------------------------------------
+        #TEMPLATES FETCH-------------------------------------------------------------------------------------------------
+        if use_templates:
+            if templates_future is not None:
                 try:
-                    new_a3m_lines = run_mmseqs2(
-                        seqs_to_search,
-                        str(result_dir.joinpath(jobname)),
-                        use_env,
-                        use_pairing=False,
-                        host_url=host_url,
-                    )
+                    a3m_lines_mmseqs2, template_paths = templates_future.result()
                 except:
                     return None
 
-                for seq_ix in range(0, len(seqs_to_search)):
-                    msa_ix = search_ix_to_msa_ix[seq_ix]
-                    a3m_lines[msa_ix] = new_a3m_lines[seq_ix]
-
-
-            final_a3ms = [a3m_lines[ix] for ix in range(0, len(query_seqs_unique))]
-            a3m_lines = final_a3ms
-
-    else:
-        a3m_lines = None
-
-
+                new_template_features = make_template_features(
+                    template_seqs_to_search, a3m_lines_mmseqs2, template_paths, custom_template_path
+                )
+                for seq_ix, template_feature in enumerate(new_template_features):
+                    template_ix = search_ix_to_template_ix[seq_ix]
+                    template_features[template_ix] = template_feature
+                    put_template_features(saved_template_features_folder, template_seqs_to_search[seq_ix], template_feature)
+        else:
+            for index in range(0, len(query_seqs_unique)):
+                template_feature = mk_mock_template(query_seqs_unique[index])
+                template_features[index] = template_feature
+
+        #-------------------------------------------------------------------------------------------------------------------
+        #-------------------------------------------------------------------------------------------------------------------
+        #UNPAIRED MSA FETCH-------------------------------------------------------------------------------------------------
+        if use_unpaired_msa:
+            if msa_mode == "single_sequence":
+                a3m_lines = []
+                num = 101
+                for i, seq in enumerate(query_seqs_unique):
+                    a3m_lines.append(f">{num + i}\n{seq}")
+            else:
+                if len(unpaired_seqs_to_search) > 0:
+                    # find normal a3ms
+                    if unpaired_future is None:
+                        new_a3m_lines = a3m_lines_mmseqs2
+                    else:
+                        try:
+                            new_a3m_lines = unpaired_future.result()
+                        except:
+                            return None
+
+                    for seq_ix in range(0, len(unpaired_seqs_to_search)):
+                        msa_ix = search_ix_to_msa_ix[seq_ix]
+                        a3m_lines[msa_ix] = new_a3m_lines[seq_ix]
+                        put_unpaired_msa(saved_unpaired_msa_features_folder, unpaired_seqs_to_search[seq_ix], new_a3m_lines[seq_ix])
+        else:
+            a3m_lines = None
 
-    #-------------------------------------------------------------------------------------------------------------------
-    #-------------------------------------------------------------------------------------------------------------------
-    #PAIRED MSA FETCH-------------------------------------------------------------------------------------------------
-    if msa_mode != "single_sequence" and (
-        pair_mode == "paired" or pair_mode == "unpaired_paired"
-    ):
-        # find paired a3m if not a homooligomers
-        if len(query_seqs_unique) > 1:
+        #-------------------------------------------------------------------------------------------------------------------
+        #-------------------------------------------------------------------------------------------------------------------
+        #PAIRED MSA FETCH-------------------------------------------------------------------------------------------------
+        if paired_future is not None:
+            # find paired a3m if not a homooligomers
             try:
-                paired_a3m_lines = run_mmseqs2(
-                    query_seqs_unique,
-                    str(result_dir.joinpath(jobname)),
-                    use_env,
-                    use_pairing=True,
-                    host_url=host_url,
-                )
+                paired_a3m_lines = paired_future.result()
             except:
                 return None
-        else:
+        elif msa_mode != "single_sequence" and (
+            pair_mode == "paired" or pair_mode == "unpaired_paired"
+        ):
             # homooligomers
             num = 101
             paired_a3m_lines = []
             for i in range(0, query_seqs_cardinality[0]):
                 paired_a3m_lines.append(f">{num+i}\n{query_seqs_unique[0]}\n")
-    else:
-        paired_a3m_lines = None
+        else:
+            paired_a3m_lines = None
 
 
     return (
@@ -721,13 +1122,19 @@ def get_msa_and_templates_v3(
         paired_a3m_lines,
         query_seqs_unique,
         query_seqs_cardinality,
-        final_template_features,
+        template_features,
     )
 
 
 
 
 
+def log_found_templates(index: int, template_domain_names: np.ndarray) -> None:
+    # the names are only decoded when the message is logged
+    if logger.isEnabledFor(logging.INFO):
+        names = [name.decode("ascii", "replace") for name in template_domain_names]
+        logger.info(f"Sequence {index} found templates: {names}")
+
 def mk_mock_template(
     query_sequence: Union[List[str], str], num_temp: int = 1
 ) -> Dict[str, Any]:
@@ -736,28 +1143,24 @@ def mk_mock_template(
         if isinstance(query_sequence, str)
         else sum(len(s) for s in query_sequence)
     )
-    output_templates_sequence = "A" * ln
-    output_confidence_scores = np.full(ln, 1.0)
-
-    templates_all_atom_positions = np.zeros(
-        (ln, templates.residue_constants.atom_type_num, 3)
-    )
-    templates_all_atom_masks = np.zeros((ln, templates.residue_constants.atom_type_num))
+    atom_type_num = templates.residue_constants.atom_type_num
+    # every residue of a mock template is the same poly-A residue without coordinates, so each
+    # feature is a read-only zero-stride view of a single value or row, independent of ln and num_temp
     templates_aatype = templates.residue_constants.sequence_to_onehot(
-        output_templates_sequence, templates.residue_constants.HHBLITS_AA_TO_ID
+        "A", templates.residue_constants.HHBLITS_AA_TO_ID
     )
     template_features = {
-        "template_all_atom_positions": np.tile(
-            templates_all_atom_positions[None], [num_temp, 1, 1, 1]
+        "template_all_atom_positions": np.broadcast_to(
+            np.float32(0), (num_temp, ln, atom_type_num, 3)
         ),
-        "template_all_atom_masks": np.tile(
-            templates_all_atom_masks[None], [num_temp, 1, 1]
+        "template_all_atom_masks": np.broadcast_to(
+            np.float32(0), (num_temp, ln, atom_type_num)
         ),
         "template_sequence": [f"none".encode()] * num_temp,
-        "template_aatype": np.tile(np.array(templates_aatype)[None], [num_temp, 1, 1]),
-        "template_confidence_scores": np.tile(
-            output_confidence_scores[None], [num_temp, 1]
+        "template_aatype": np.broadcast_to(
+            templates_aatype, (num_temp, ln, templates_aatype.shape[-1])
         ),
+        "template_confidence_scores": np.broadcast_to(np.float32(1), (num_temp, ln)),
         "template_domain_names": [f"none".encode()] * num_temp,
         "template_release_date": [f"none".encode()] * num_temp,
         "template_sum_probs": np.zeros([num_temp], dtype=np.float32),
@@ -787,10 +1190,20 @@ def mk_template(
     )
     return dict(templates_result.features)
 
+MMCIF_KEY_RE = re.compile(rb"^(_\S+)", re.MULTILINE)
+
+def read_mmcif_keys(cif_file: Path) -> set:
+    """data names of a cif file, found by scanning it instead of parsing all values"""
+    with open(cif_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return set()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return {key.decode() for key in MMCIF_KEY_RE.findall(mm)}
+
 def validate_and_fix_mmcif(cif_file: Path):
     """validate presence of _entity_poly_seq in cif file and add revision_date if missing"""
     # check that required poly_seq and revision_date fields are present
-    cif_dict = MMCIF2Dict.MMCIF2Dict(cif_file)
+    cif_keys = read_mmcif_keys(cif_file)
     required = [
         "_chem_comp.id",
         "_chem_comp.type",
@@ -799,9 +1212,9 @@ def validate_and_fix_mmcif(cif_file: Path):
         "_entity_poly_seq.mon_id",
     ]
     for r in required:
-        if r not in cif_dict:
+        if r not in cif_keys:
             raise ValueError(f"mmCIF file {cif_file} is missing required field {r}.")
-    if "_pdbx_audit_revision_history.revision_date" not in cif_dict:
+    if "_pdbx_audit_revision_history.revision_date" not in cif_keys:
         logger.info(
             f"Adding missing field revision_date to {cif_file}. Backing up original file to {cif_file}.bak."
         )
@@ -809,14 +1222,16 @@ def validate_and_fix_mmcif(cif_file: Path):
         with open(cif_file, "a") as f:
             f.write(CIF_REVISION_DATE)
 
+# biopython parsers reset their state on every get_structure call, so one instance per process is reused
+_PDB_PARSER = PDBParser(QUIET=True)
+
 def convert_pdb_to_mmcif(pdb_file: Path):
     """convert existing pdb files into mmcif with the required poly_seq and revision_date"""
     i = pdb_file.stem
     cif_file = pdb_file.parent.joinpath(f"{i}.cif")
     if cif_file.is_file():
         return
-    parser = PDBParser(QUIET=True)
-    structure = parser.get_structure(i, pdb_file)
+    structure = _PDB_PARSER.get_structure(i, pdb_file)
     cif_io = CFMMCIFIO()
     cif_io.set_structure(structure)
     cif_io.save(str(cif_file))
@@ -824,6 +1239,7 @@ def convert_pdb_to_mmcif(pdb_file: Path):
 def mk_hhsearch_db(template_dir: str):
     template_path = Path(template_dir)
 
+    # only cif files that were already present are validated, the ones converted from pdb below have all required fields
     cif_files = template_path.glob("*.cif")
     for cif_file in cif_files:
         validate_and_fix_mmcif(cif_file)
@@ -836,6 +1252,17 @@ def mk_hhsearch_db(template_dir: str):
     for f in pdb70_db_files:
         os.remove(f)
 
+    # parsing is pure python and independent per file, so larger template directories are parsed
+    # in a process pool. spawn instead of fork, the parent already runs jax threads. the workers
+    # only import colabfold.templates, not this module
+    cif_files = sorted(template_path.glob("*.cif"))
+    if len(cif_files) >= 16 and (os.cpu_count() or 1) > 1:
+        mp_context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(os.cpu_count(), len(cif_files)), mp_context=mp_context) as executor:
+            cif_chains = list(executor.map(parse_cif_chains, cif_files, chunksize=8))
+    else:
+        cif_chains = [parse_cif_chains(cif_file) for cif_file in cif_files]
+
     with open(template_path.joinpath("pdb70_a3m.ffdata"), "w") as a3m, open(
         template_path.joinpath("pdb70_cs219.ffindex"), "w"
     ) as cs219_index, open(
@@ -845,33 +1272,9 @@ def mk_hhsearch_db(template_dir: str):
     ) as cs219:
         n = 1000000
         index_offset = 0
-        cif_files = template_path.glob("*.cif")
-        for cif_file in cif_files:
-            with open(cif_file) as f:
-                cif_string = f.read()
-            cif_fh = StringIO(cif_string)
-            parser = MMCIFParser(QUIET=True)
-            structure = parser.get_structure("none", cif_fh)
-            models = list(structure.get_models())
-            if len(models) != 1:
-                raise ValueError(
-                    f"Only single model PDBs are supported. Found {len(models)} models."
-                )
-            model = models[0]
-            for chain in model:
-                amino_acid_res = []
-                for res in chain:
-                    if res.id[2] != " ":
-                        raise ValueError(
-                            f"PDB contains an insertion code at chain {chain.id} and residue "
-                            f"index {res.id[1]}. These are not supported."
-                        )
-                    amino_acid_res.append(
-                        residue_constants.restype_3to1.get(res.resname, "X")
-                    )
-
-                protein_str = "".join(amino_acid_res)
-                a3m_str = f">{cif_file.stem}_{chain.id}\n{protein_str}\n\0"
+        for chains in cif_chains:
+            for name, protein_str in chains:
+                a3m_str = f">{name}\n{protein_str}\n\0"
                 a3m_str_len = len(a3m_str)
                 a3m_index.write(f"{n}\t{index_offset}\t{a3m_str_len}\n")
                 cs219_index.write(f"{n}\t{index_offset}\t{len(protein_str)}\n")
@@ -914,11 +1317,31 @@ def pad_input(
     )  # template_mask (4, 4) second value
     return input_fix
 
+PAD_BUCKETS = (128, 256, 384, 512)
+# beyond the largest bucket the compute grows quadratically with the padded length,
+# so longer inputs are padded to a multiple of the step but by at most a fraction of their length
+PAD_BUCKET_STEP = 128
+PAD_BUCKET_MAX_FRACTION = 0.1
+
+def bucket_pad_len(seq_len: int, buckets: Tuple[int, ...] = PAD_BUCKETS) -> int:
+    """Round seq_len up to a fixed ladder of lengths, so queries of similar length share one compiled model.
+    Beyond the largest bucket, round up to a multiple of PAD_BUCKET_STEP, padding by at most
+    PAD_BUCKET_MAX_FRACTION of the length."""
+    for bucket in buckets:
+        if bucket >= seq_len:
+            return bucket
+    bucket = math.ceil(seq_len / PAD_BUCKET_STEP) * PAD_BUCKET_STEP
+    return min(bucket, math.ceil(seq_len * (1 + PAD_BUCKET_MAX_FRACTION)))
+
+def is_out_of_memory(error: Exception) -> bool:
+    """Whether a RuntimeError raised by jax/xla is an allocation failure on the device"""
+    message = str(error)
+    return "RESOURCE_EXHAUSTED" in message or "out of memory" in message.lower()
+
 def relax_me(pdb_filename=None, pdb_lines=None, pdb_obj=None, use_gpu=False):
-    if "relax" not in dir():
-        patch_openmm()
-        from alphafold.common import residue_constants
-        from alphafold.relax import relax
+    # openmm and the alphafold relax module are only imported when relaxing, the patch is applied once
+    patch_openmm()
+    from alphafold.relax import relax
 
     if pdb_obj is None:        
         if pdb_lines is None:
@@ -936,6 +1359,56 @@ def relax_me(pdb_filename=None, pdb_lines=None, pdb_obj=None, use_gpu=False):
     relaxed_pdb_lines, _, _ = amber_relaxer.process(prot=pdb_obj)
     return relaxed_pdb_lines
 
+# compressing and writing the outputs of a model runs on an io pool of run() (or of a direct
+# predict_structure call), while the next model is already predicting. lzma releases the gil,
+# so this overlaps with the main thread
+IO_POOL_WORKERS = 2
+
+def scores_to_json(scores: Dict[str, Any]) -> bytes:
+    """compact json of a scores dict whose "pae" entry is an integer numpy matrix, encoded without
+    turning the whole matrix into nested lists of python ints"""
+    if orjson is not None:
+        return orjson.dumps(scores, option=orjson.OPT_SERIALIZE_NUMPY)
+    items = []
+    for key, value in scores.items():
+        if key == "pae":
+            value_txt = "[" + ",".join("[" + ",".join(map(str, row.tolist())) + "]" for row in value) + "]"
+        else:
+            value_txt = json.dumps(value)
+        items.append(f"{json.dumps(key)}:{value_txt}")
+    return ("{" + ",".join(items) + "}").encode("utf-8")
+
+def array_to_json(array: np.ndarray) -> bytes:
+    """compact json of an integer numpy array, orjson encodes it without the nested python lists"""
+    if orjson is not None:
+        return orjson.dumps(np.ascontiguousarray(array), option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(array.tolist(), separators=(',', ':')).encode("utf-8")
+
+def _write_lzma(filename: str, data: bytes):
+    # preset 1 compresses these text files nearly as well as the default 6 at a fraction of the cpu time
+    with lzma.open(filename, 'wb', preset=1) as handle:
+        handle.write(data)
+
+# outputs that are compressed already gain nothing from deflate
+ZIP_STORED_SUFFIXES = {".xz", ".gz", ".zip", ".npz", ".png", ".webp"}
+
+def write_result_zip(zip_filename: Union[str, Path], files: List[Path], deflate: bool = False):
+    # the files are stored uncompressed by default, which costs no cpu time. with deflate the pickles,
+    # npy and pdb files are deflated at level 1, most of the size reduction for little cpu time
+    with zipfile.ZipFile(zip_filename, "w") as result_zip:
+        for file in files:
+            if not deflate or file.suffix in ZIP_STORED_SUFFIXES:
+                result_zip.write(file, arcname=file.name, compress_type=zipfile.ZIP_STORED)
+            else:
+                result_zip.write(file, arcname=file.name, compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+def _write_lzma_text(filename: str, texts: List[str], chunk_size: int = 1 << 20):
+    # encodes the texts in chunks, so no full utf-8 copy (or concatenation) of a large msa is built
+    with lzma.open(filename, 'wb', preset=1) as handle:
+        for text in texts:
+            for start in range(0, len(text), chunk_size):
+                handle.write(text[start:start + chunk_size].encode("utf-8"))
+
 
 
 
@@ -958,6 +1431,43 @@ class file_manager:
     def set_tag(self, tag):
         self.tag = tag
 
+# remarks at the top of every predicted pdb, per model data first
+_REMARK_DATA_TEMPLATE = (
+    "REMARK 801  DATA generated_by=jwalterlab_fold_portal_HMS\n"
+    "REMARK 802  DATA fold_id={fold_id}\n"
+    "REMARK 803  DATA model_gen_time={model_gen_time}\n"
+    "REMARK 804  DATA model_name={model_name}\n"
+    "REMARK 805  DATA PAE_json_file_md5={pae_file_md5}\n"
+    "REMARK 806  DATA PAE_file_id={pae_file_id}"
+)
+
+# run settings after the TEMPLATE remarks as (config key, default, quoted)
+_REMARK_SETTINGS = (
+    ("use_templates", False, False),
+    ("use_dropout", False, False),
+    ("msa_mode", "null", True),
+    ("model_type", "null", True),
+    ("num_recycles", "null", False),
+    ("recycle_early_stop_tolerance", "null", False),
+    ("num_ensemble", "null", False),
+    ("max_seq", "null", False),
+    ("max_extra_seq", "null", False),
+    ("pair_mode", "null", True),
+    ("host_url", "null", True),
+    ("stop_at_score", "null", False),
+    ("random_seed", "null", False),
+    ("use_cluster_profile", False, False),
+    ("use_fuse", False, False),
+    ("use_bfloat16", False, False),
+    ("version", "null", True),
+)
+
+# the remark numbers are positional fields, they shift with the number of TEMPLATE remarks
+_REMARK_SETTINGS_TEMPLATE = "\n".join(
+    f"REMARK {{{n}}}  SETTING {key}=" + (f'"{{settings[{key}]}}"' if quoted else f"{{settings[{key}]}}")
+    for n, (key, _, quoted) in enumerate(_REMARK_SETTINGS)
+)
+
 def predict_structure(
     prefix: str,
     result_dir: Path,
@@ -980,6 +1490,9 @@ def predict_structure(
     save_single_representations: bool = False,
     save_pair_representations: bool = False,
     save_recycles: bool = False,
+    save_distogram: bool = False,
+    config_filename: str = "config.json",
+    io_pool: Optional[ThreadPoolExecutor] = None,
 ):
     """Predicts structure using AlphaFold for the given sequence."""
 
@@ -991,6 +1504,33 @@ def predict_structure(
     files = file_manager(prefix, result_dir)
     seq_len = sum(sequences_lengths)
     fold_id = get_fold_id(prefix)
+    # background writes, waited for before the files are renamed by rank
+    pending_writes = []
+    own_io_pool = io_pool is None
+    if own_io_pool:
+        io_pool = ThreadPoolExecutor(max_workers=IO_POOL_WORKERS)
+
+    # the TEMPLATE and SETTING remarks of the pdb files only depend on the run config, render them once
+    with open(result_dir.joinpath(config_filename), 'r') as json_file:
+        config = json.load(json_file)
+    config_remark_lines = []
+    remark_index = 807
+    if config.get('use_templates', False):
+        for chain, templates in template_domains.items():
+            templates = templates[0:feature_processing.MAX_TEMPLATES]
+            config_remark_lines.append(f"REMARK {remark_index}  TEMPLATE CHAIN:{chain} " + " ".join(templates))
+            remark_index += 1
+    settings = {key: config.get(key, default) for key, default, _ in _REMARK_SETTINGS}
+    config_remark_lines.append(_REMARK_SETTINGS_TEMPLATE.format(
+        *range(remark_index, remark_index + len(_REMARK_SETTINGS)), settings=settings))
+    config_remarks = "\n".join(config_remark_lines)
+    recycle_remark_index = remark_index + len(_REMARK_SETTINGS)
+
+    # process_features runs once per seed and converts the integer deletion matrix on every call,
+    # convert it once here. the rest of the feature processing samples the msa and depends on the seed
+    if "multimer" not in model_type and "deletion_matrix_int" in feature_dict:
+        feature_dict = dict(feature_dict)
+        feature_dict["deletion_matrix"] = feature_dict.pop("deletion_matrix_int").astype(np.float32)
 
     # iterate through random seeds
     for seed_num, seed in enumerate(range(random_seed, random_seed+num_seeds)):
@@ -1008,12 +1548,16 @@ def predict_structure(
                 if model_num == 0 and seed_num == 0:
                     # TODO: add pad_input_mulitmer()
                     input_features = feature_dict
-                    input_features["asym_id"] = input_features["asym_id"] - input_features["asym_id"][...,0]
+                    # shift in place, numpy buffers the overlapping first column itself
+                    asym_id = input_features["asym_id"]
+                    np.subtract(asym_id, asym_id[...,0:1], out=asym_id)
             else:
                 if model_num == 0:
                     input_features = model_runner.process_features(feature_dict, random_seed=seed)            
                     r = input_features["aatype"].shape[0]
-                    input_features["asym_id"] = np.tile(feature_dict["asym_id"],r).reshape(r,-1)
+                    # read-only view repeating the row r times, padding and the device transfer copy it anyway
+                    asym_id = feature_dict["asym_id"]
+                    input_features["asym_id"] = np.broadcast_to(asym_id[None, :], (r, asym_id.shape[0]))
                     if seq_len < pad_len:
                         input_features = pad_input(input_features, model_runner, 
                             model_name, pad_len, use_templates)
@@ -1059,7 +1603,7 @@ def predict_structure(
                 
                     if save_all:
                         with files.get("all",f"r{recycles}.pickle").open("wb") as handle:
-                            pickle.dump(result, handle)
+                            pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
                     del unrelaxed_protein
             
             return_representations = save_all or save_single_representations or save_pair_representations
@@ -1108,119 +1652,87 @@ def predict_structure(
             # save results
             #########################      
 
-            #write out distogram probability distribution for every residue pair ij               
-            # dist_probabilities = np.rint(100*np.apply_along_axis(tf.nn.softmax, 2, result['distogram']['logits']))
-            # dist_probabilities_list = dist_probabilities.astype(int).tolist()
-
-            # dist_maxes = np.apply_along_axis(np.amax, 2, dist_probabilities)
-            # dist_max_list = dist_maxes.astype(int).tolist()
-
-            # with lzma.open(str(files.get("dgram","json.xz")), "wb") as write_file:
-            #     dist_txt = json.dumps(dist_probabilities_list, separators=(',', ':'))
-            #     write_file.write(dist_txt.encode("utf-8"))
-
-            # with lzma.open(str(files.get("dgram_max","json.xz")), "wb") as write_file:
-            #     dist_txt = json.dumps(dist_max_list, separators=(',', ':'))
-            #     write_file.write(dist_txt.encode("utf-8"))
-
-            # save raw outputs
+            # save raw outputs, these need the full result
             if save_all:
                 with files.get("all","pickle").open("wb") as handle:
-                    pickle.dump(result, handle)
+                    pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
             if save_single_representations:
                 np.save(files.get("single_repr","npy"),result["representations"]["single"])
             if save_pair_representations:
                 np.save(files.get("pair_repr","npy"),result["representations"]["pair"])
 
+            # keep only the arrays needed below and free the rest of the result (representations can be
+            # gigabytes for long sequences) before the outputs are serialized and compressed
+            pae = None
+            if "predicted_aligned_error" in result:
+                pae = result["predicted_aligned_error"][:seq_len,:seq_len]
+            if save_distogram:
+                logits = np.asarray(result["distogram"]["logits"])[:seq_len, :seq_len]
+            del result
+
+            # write out the distogram probability distribution (in percent) of every residue pair ij and its maximum
+            if save_distogram:
+                # softmax over the distance bins as whole-array operations, shifted by the max for stability
+                dist_probabilities = np.exp(logits - logits.max(axis=-1, keepdims=True))
+                dist_probabilities /= dist_probabilities.sum(axis=-1, keepdims=True)
+                dist_probabilities = np.rint(100 * dist_probabilities).astype(np.int8)
+                del logits
+
+                dist_bytes = array_to_json(dist_probabilities)
+                pending_writes.append(io_pool.submit(_write_lzma, str(files.get("dgram","json.xz")), dist_bytes))
+
+                dist_bytes = array_to_json(dist_probabilities.max(axis=-1))
+                pending_writes.append(io_pool.submit(_write_lzma, str(files.get("dgram_max","json.xz")), dist_bytes))
+                del dist_probabilities, dist_bytes
 
             json_id = str(uuid.uuid4())
 
             # write an easy-to-use format (pAE and pLDDT)
             score_filename = str(files.get("scores","json.xz"))
-            with lzma.open(score_filename, 'wb') as handle:
-                if "predicted_aligned_error" in result:
-                  pae   = result["predicted_aligned_error"][:seq_len,:seq_len]
-                  plot_pae(pae, score_filename + "_pae.png", sequences_lengths)
-                  scores = {
-                    "id":json_id,
-                    "fold_id":fold_id,
-                    "max_pae": pae.max().astype(float).item(),
-                    "pae": pae.astype(int).tolist(),
-                  }
-                  for k in ["ptm","iptm"]:
-                    if k in conf[-1]: scores[k] = np.around(conf[-1][k], 2).item()
-                  pae_txt = json.dumps(scores, separators=(',', ':'))
-                  handle.write(pae_txt.encode("utf-8"))
-                  del pae
-                  del scores
+            scores_bytes = b""
+            if pae is not None:
+              # the pae figure is shared, so it is drawn here and not on the io threads
+              plot_pae(pae, score_filename + "_pae.png", sequences_lengths)
+              scores = {
+                "id":json_id,
+                "fold_id":fold_id,
+                "max_pae": pae.max().astype(float).item(),
+                # pae values stay well below 2^15, int16 truncates like the former int conversion
+                "pae": pae.astype(np.int16),
+              }
+              for k in ["ptm","iptm"]:
+                if k in conf[-1]: scores[k] = np.around(conf[-1][k], 2).item()
+              scores_bytes = scores_to_json(scores)
+              del pae
+              del scores
+            pending_writes.append(io_pool.submit(_write_lzma, score_filename, scores_bytes))
             
-            pae_file_md5_hash = hashlib.md5(pae_txt.encode('utf-8')).hexdigest()
+            pae_file_md5_hash = hashlib.md5(scores_bytes).hexdigest()
             
             # save pdb
             protein_lines = protein.to_pdb(unrelaxed_protein)
 
-            config_out_file = result_dir.joinpath("config.json")
-            # Read configuration data from the JSON file
-            with open(config_out_file, 'r') as json_file:
-                config = json.load(json_file)
-
-
             #ADD SETTINGS TO THE FINAL PDB FILE ES EDIT
-            new_settings_lines_str = ''
-            remark_index = 800
-            new_settings_lines_str += f"REMARK {remark_index + 1}  DATA generated_by=jwalterlab_fold_portal_HMS\n"
-            datetimestr = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S') + " UTC"
-            new_settings_lines_str += f"REMARK {remark_index + 2}  DATA fold_id={fold_id}\n"
-            new_settings_lines_str += f"REMARK {remark_index + 3}  DATA model_gen_time={datetimestr}\n"
-            new_settings_lines_str += f"REMARK {remark_index + 4}  DATA model_name={model_name}\n"
-            new_settings_lines_str += f"REMARK {remark_index + 5}  DATA PAE_json_file_md5={pae_file_md5_hash}\n"
-            new_settings_lines_str += f"REMARK {remark_index + 6}  DATA PAE_file_id={json_id}\n"
-            remark_index += 7
-
-            if(config.get('use_templates', False)):
-                for index, (chain, templates) in enumerate(template_domains.items()):
-
-                    templates = templates[0:feature_processing.MAX_TEMPLATES]
-                    new_settings_lines_str += f"REMARK {remark_index}  TEMPLATE CHAIN:{chain} " + " ".join(templates) + "\n"
-                    remark_index += 1
-
-                
-            
-            json_remarks = [
-                f"REMARK {remark_index}  SETTING use_templates={config.get('use_templates', False)}",
-                f"REMARK {remark_index + 1}  SETTING use_dropout={config.get('use_dropout', False)}",
-                f"REMARK {remark_index + 2}  SETTING msa_mode=\"{config.get('msa_mode', 'null')}\"",
-                f"REMARK {remark_index + 3}  SETTING model_type=\"{config.get('model_type', 'null')}\"",
-                f"REMARK {remark_index + 4}  SETTING num_recycles={config.get('num_recycles', 'null')}",
-                f"REMARK {remark_index + 5}  SETTING recycle_early_stop_tolerance={config.get('recycle_early_stop_tolerance', 'null')}",
-                f"REMARK {remark_index + 6}  SETTING num_ensemble={config.get('num_ensemble', 'null')}",
-                f"REMARK {remark_index + 7}  SETTING max_seq={config.get('max_seq', 'null')}",
-                f"REMARK {remark_index + 8}  SETTING max_extra_seq={config.get('max_extra_seq', 'null')}",
-                f"REMARK {remark_index + 9}  SETTING pair_mode=\"{config.get('pair_mode', 'null')}\"",
-                f"REMARK {remark_index + 10}  SETTING host_url=\"{config.get('host_url', 'null')}\"",
-                f"REMARK {remark_index + 11}  SETTING stop_at_score={config.get('stop_at_score', 'null')}",
-                f"REMARK {remark_index + 12}  SETTING random_seed={config.get('random_seed', 'null')}",
-                f"REMARK {remark_index + 13}  SETTING use_cluster_profile={config.get('use_cluster_profile', False)}",
-                f"REMARK {remark_index + 14}  SETTING use_fuse={config.get('use_fuse', False)}",
-                f"REMARK {remark_index + 15}  SETTING use_bfloat16={config.get('use_bfloat16', False)}",
-                f"REMARK {remark_index + 16}  SETTING version=\"{config.get('version', 'null')}\""
+            remark_lines = [
+                _REMARK_DATA_TEMPLATE.format(
+                    fold_id=fold_id,
+                    model_gen_time=datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S') + " UTC",
+                    model_name=model_name,
+                    pae_file_md5=pae_file_md5_hash,
+                    pae_file_id=json_id,
+                ),
+                config_remarks,
             ]
+            for n, r in enumerate(recycle_stats):
+                remark_lines.append(f"REMARK {recycle_remark_index + n}  RECYCLESTAT pLDDT={r['mean_plddt']:.1f} pTM={r['ptm']:.3f} ipTM={r['iptm']:.3f} recycle={r['recycle_index']} tol={r['tol']:.2f}")
 
-            for remark in json_remarks:
-                new_settings_lines_str += f"{remark}\n"
-                remark_index += 1
-
-            for r in recycle_stats:
-                new_settings_lines_str += f"REMARK {remark_index}  RECYCLESTAT pLDDT={r['mean_plddt']:.1f} pTM={r['ptm']:.3f} ipTM={r['iptm']:.3f} recycle={r['recycle_index']} tol={r['tol']:.2f}\n"
-                remark_index += 1
-
-            protein_lines = new_settings_lines_str + protein_lines
+            remark_lines.append(protein_lines)
+            protein_lines = "\n".join(remark_lines)
             pdb_filename = str(files.get("unrelaxed","pdb.xz"))
-            with lzma.open(pdb_filename, 'wb') as handle:
-                handle.write(protein_lines.encode("utf-8"))
+            pending_writes.append(io_pool.submit(_write_lzma, pdb_filename, protein_lines.encode("utf-8")))
             
             
-            del result, unrelaxed_protein
+            del unrelaxed_protein
 
             # early stop criteria fulfilled
             if mean_scores[-1] > stop_at_score: break
@@ -1232,6 +1744,12 @@ def predict_structure(
         if "multimer" not in model_type: del input_features
     if "multimer" in model_type: del input_features
 
+    # all outputs have to be on disk before they are renamed, result() re-raises any write error
+    for future in pending_writes:
+        future.result()
+    if own_io_pool:
+        io_pool.shutdown(wait=True)
+
     ###################################################
     # rerank models based on predicted confidence
     ###################################################
@@ -1276,22 +1794,22 @@ def parse_fasta(fasta_string: str) -> Tuple[List[str], List[str]]:
       * A list of sequence descriptions taken from the comment lines. In the
         same order as the sequences.
     """
-    sequences = []
+    # collect the lines of each sequence and join them once, a3m inputs can have many lines per sequence
+    sequence_lines = []
     descriptions = []
-    index = -1
     for line in fasta_string.splitlines():
         line = line.strip()
         if line.startswith("#"):
             continue
         if line.startswith(">"):
-            index += 1
             descriptions.append(line[1:])  # Remove the '>' at the beginning.
-            sequences.append("")
+            sequence_lines.append([])
             continue
         elif not line:
             continue  # Skip blank lines.
-        sequences[index] += line
+        sequence_lines[-1].append(line)
 
+    sequences = ["".join(lines) for lines in sequence_lines]
     return sequences, descriptions
 
 def get_queries(
@@ -1317,23 +1835,25 @@ def get_queries(
                 if len(queries[i][1]) == 1:
                     queries[i] = (queries[i][0], queries[i][1][0], None)
         elif input_path.suffix == ".a3m":
-            (seqs, header) = parse_fasta(input_path.read_text())
+            msa_text = input_path.read_text()
+            (seqs, header) = parse_fasta(msa_text)
             if len(seqs) == 0:
                 raise ValueError(f"{input_path} is empty")
             query_sequence = seqs[0]
             # Use a list so we can easily extend this to multiple msas later
-            a3m_lines = [input_path.read_text()]
+            a3m_lines = [msa_text]
             queries = [(input_path.stem, query_sequence, a3m_lines)]
-        elif input_path.suffix == ".a3m.xz":
-
-            msa_text = lzma.open(str(input_path),mode='rt', encoding='utf-8').read()
+        elif input_path.name.endswith(".a3m.xz"):
+            # Path.suffix only sees ".xz", so match on the full name
+            with lzma.open(str(input_path), mode='rt', encoding='utf-8') as handle:
+                msa_text = handle.read()
             (seqs, header) = parse_fasta(msa_text)
             if len(seqs) == 0:
                 raise ValueError(f"{input_path} is empty")
             query_sequence = seqs[0]
             # Use a list so we can easily extend this to multiple msas later
             a3m_lines = [msa_text]
-            queries = [(input_path.stem, query_sequence, a3m_lines)]
+            queries = [(input_path.name[:-len(".a3m.xz")], query_sequence, a3m_lines)]
         elif input_path.suffix in [".fasta", ".faa", ".fa"]:
             (sequences, headers) = parse_fasta(input_path.read_text())
             queries = []
@@ -1356,7 +1876,8 @@ def get_queries(
             if file.suffix.lower() not in [".a3m", ".fasta", ".faa"]:
                 logger.warning(f"non-fasta/a3m file in input directory: {file}")
                 continue
-            (seqs, header) = parse_fasta(file.read_text())
+            file_text = file.read_text()
+            (seqs, header) = parse_fasta(file_text)
             if len(seqs) == 0:
                 logger.error(f"{file} is empty")
                 continue
@@ -1367,7 +1888,7 @@ def get_queries(
                 )
 
             if file.suffix.lower() == ".a3m":
-                a3m_lines = [file.read_text()]
+                a3m_lines = [file_text]
                 queries.append((file.stem, query_sequence.upper(), a3m_lines))
             else:
                 if query_sequence.count(":") == 0:
@@ -1379,8 +1900,13 @@ def get_queries(
 
     # sort by seq. len
     if sort_queries_by == "length":
-        queries.sort(key=lambda t: len("".join(t[1])))
+        # group by complex/monomer and padded length, so jobs that share a compiled model run back to back
+        queries.sort(key=lambda t: (isinstance(t[1], list), bucket_pad_len(len("".join(t[1]))), len("".join(t[1]))))
     
+    elif sort_queries_by == "bucket":
+        # only group by complex/monomer and padded length, the input order is kept inside a bucket
+        queries.sort(key=lambda t: (isinstance(t[1], list), bucket_pad_len(len("".join(t[1])))))
+
     elif sort_queries_by == "random":
         random.shuffle(queries)
     
@@ -1410,17 +1936,18 @@ def get_queries(
 def pair_sequences(
     a3m_lines: List[str], query_sequences: List[str], query_cardinality: List[int]
 ) -> str:
-    a3m_line_paired = [""] * len(a3m_lines[0].splitlines())
+    # split every msa once, and collect the pieces of every paired line to join once at the end
+    split_a3m_lines = [a3m_lines[n].splitlines() for n in range(len(query_sequences))]
+    a3m_line_paired = [[] for _ in range(len(split_a3m_lines[0]))]
     for n, seq in enumerate(query_sequences):
-        lines = a3m_lines[n].splitlines()
-        for i, line in enumerate(lines):
+        for i, line in enumerate(split_a3m_lines[n]):
             if line.startswith(">"):
                 if n != 0:
                     line = line.replace(">", "\t", 1)
-                a3m_line_paired[i] = a3m_line_paired[i] + line
+                a3m_line_paired[i].append(line)
             else:
-                a3m_line_paired[i] = a3m_line_paired[i] + line * query_cardinality[n]
-    return "\n".join(a3m_line_paired)
+                a3m_line_paired[i].append(line * query_cardinality[n])
+    return "\n".join("".join(parts) for parts in a3m_line_paired)
 
 def pad_sequences(
     a3m_lines: List[str], query_sequences: List[str], query_cardinality: List[int]
@@ -1433,17 +1960,17 @@ def pad_sequences(
     a3m_lines_combined = []
     pos = 0
     for n, seq in enumerate(query_sequences):
+        # the same msa is repeated for every copy of the chain, split it once
+        lines = [a3m_line for a3m_line in a3m_lines[n].split("\n") if len(a3m_line) > 0]
         for j in range(0, query_cardinality[n]):
-            lines = a3m_lines[n].split("\n")
+            # gaps for all other chains, identical for every line of this copy
+            prefix = "".join(_blank_seq[:pos])
+            suffix = "".join(_blank_seq[pos + 1 :])
             for a3m_line in lines:
-                if len(a3m_line) == 0:
-                    continue
                 if a3m_line.startswith(">"):
                     a3m_lines_combined.append(a3m_line)
                 else:
-                    a3m_lines_combined.append(
-                        "".join(_blank_seq[:pos] + [a3m_line] + _blank_seq[pos + 1 :])
-                    )
+                    a3m_lines_combined.append(prefix + a3m_line + suffix)
             pos += 1
     return "\n".join(a3m_lines_combined)
 
@@ -1459,66 +1986,76 @@ def get_msa_and_templates(
 ) -> Tuple[
     Optional[List[str]], Optional[List[str]], List[str], List[int], List[Dict[str, Any]]
 ]:
-    from colabfold.colabfold import run_mmseqs2
-
     use_env = msa_mode == "mmseqs2_uniref_env"
     if isinstance(query_sequences, str): query_sequences = [query_sequences]
 
-    # remove duplicates before searching
-    query_seqs_unique = []
-    for x in query_sequences:
-        if x not in query_seqs_unique:
-            query_seqs_unique.append(x)
+    # remove duplicates before searching (dict keys keep the first-seen order)
+    query_seqs_unique = list(dict.fromkeys(query_sequences))
 
     # determine how many times is each sequence is used
+    seq_to_index = {seq: index for index, seq in enumerate(query_seqs_unique)}
     query_seqs_cardinality = [0] * len(query_seqs_unique)
     for seq in query_sequences:
-        seq_idx = query_seqs_unique.index(seq)
-        query_seqs_cardinality[seq_idx] += 1
+        query_seqs_cardinality[seq_to_index[seq]] += 1
+
+    # the unpaired msa and the templates of a chain only depend on its sequence, the msa mode and the server,
+    # so they are cached per chain and reused by every job writing to result_dir, e.g. an all-vs-all screen of
+    # a few monomers. only the chains missing from the cache are searched
+    server_id = hashlib.md5(host_url.encode('utf-8')).hexdigest()
+    feature_cache_dir = result_dir.joinpath("_feature_cache", msa_mode, server_id)
+    template_cache_dir = feature_cache_dir.joinpath("templates")
+    cached_files = list_store(feature_cache_dir)
+    seq_ids = [aa_seq_to_id(seq) for seq in query_seqs_unique]
 
     # get template features
-    template_features = []
+    template_features = [None] * len(query_seqs_unique)
     if use_templates:
-        a3m_lines_mmseqs2, template_paths = run_mmseqs2(
-            query_seqs_unique,
-            str(result_dir.joinpath(jobname)),
-            use_env,
-            use_templates=True,
-            host_url=host_url,
-        )
-        if custom_template_path is not None:
-            template_paths = {}
-            for index in range(0, len(query_seqs_unique)):
-                template_paths[index] = custom_template_path
-        if template_paths is None:
-            logger.info("No template detected")
-            for index in range(0, len(query_seqs_unique)):
-                template_feature = mk_mock_template(query_seqs_unique[index])
-                template_features.append(template_feature)
-        else:
-            for index in range(0, len(query_seqs_unique)):
-                if template_paths[index] is not None:
+        # features of a custom template path are not cached, they depend on the templates in it
+        if custom_template_path is None:
+            cached_template_files = list_store(template_cache_dir)
+            template_features = map_concurrently(
+                lambda seq_id: load_stored_template_features(template_cache_dir, seq_id, cached_template_files), seq_ids
+            )
+        indices_to_search = [index for index in range(len(query_seqs_unique)) if template_features[index] is None]
+        seqs_to_search = [query_seqs_unique[index] for index in indices_to_search]
+
+        if len(seqs_to_search) > 0:
+            a3m_lines_mmseqs2, template_paths = run_mmseqs2_throttled(
+                seqs_to_search,
+                str(result_dir.joinpath(jobname)),
+                use_env,
+                use_templates=True,
+                host_url=host_url,
+            )
+            if custom_template_path is not None:
+                template_paths = [custom_template_path] * len(seqs_to_search)
+            if template_paths is None:
+                logger.info("No template detected")
+            for seq_ix, index in enumerate(indices_to_search):
+                if template_paths is not None and template_paths[seq_ix] is not None:
                     template_feature = mk_template(
-                        a3m_lines_mmseqs2[index],
-                        template_paths[index],
+                        a3m_lines_mmseqs2[seq_ix],
+                        template_paths[seq_ix],
                         query_seqs_unique[index],
                     )
                     if len(template_feature["template_domain_names"]) == 0:
                         template_feature = mk_mock_template(query_seqs_unique[index])
                         logger.info(f"Sequence {index} found no templates")
                     else:
-                        logger.info(
-                            f"Sequence {index} found templates: {template_feature['template_domain_names'].astype(str).tolist()}"
-                        )
+                        log_found_templates(index, template_feature["template_domain_names"])
                 else:
                     template_feature = mk_mock_template(query_seqs_unique[index])
-                    logger.info(f"Sequence {index} found no templates")
+                    if template_paths is not None:
+                        logger.info(f"Sequence {index} found no templates")
 
-                template_features.append(template_feature)
+                template_features[index] = template_feature
+                if custom_template_path is None:
+                    template_cache_dir.mkdir(parents=True, exist_ok=True)
+                    save_template_features(template_feature, template_cache_dir.joinpath(f"{seq_ids[index]}.npz"))
     else:
         for index in range(0, len(query_seqs_unique)):
             template_feature = mk_mock_template(query_seqs_unique[index])
-            template_features.append(template_feature)
+            template_features[index] = template_feature
 
     if len(query_sequences) == 1:
         pair_mode = "none"
@@ -1531,13 +2068,22 @@ def get_msa_and_templates(
                 a3m_lines.append(f">{num + i}\n{seq}")
         else:
             # find normal a3ms
-            a3m_lines = run_mmseqs2(
-                query_seqs_unique,
-                str(result_dir.joinpath(jobname)),
-                use_env,
-                use_pairing=False,
-                host_url=host_url,
+            a3m_lines = map_concurrently(
+                lambda seq_id: load_stored_unpaired_msa(feature_cache_dir, seq_id, cached_files), seq_ids
             )
+            indices_to_search = [index for index in range(len(query_seqs_unique)) if a3m_lines[index] is None]
+            if len(indices_to_search) > 0:
+                new_a3m_lines = run_mmseqs2_throttled(
+                    [query_seqs_unique[index] for index in indices_to_search],
+                    str(result_dir.joinpath(jobname)),
+                    use_env,
+                    use_pairing=False,
+                    host_url=host_url,
+                )
+                feature_cache_dir.mkdir(parents=True, exist_ok=True)
+                for seq_ix, index in enumerate(indices_to_search):
+                    a3m_lines[index] = new_a3m_lines[seq_ix]
+                    save_unpaired_msa(new_a3m_lines[seq_ix], feature_cache_dir.joinpath(f"{seq_ids[index]}.a3m.gz"))
     else:
         a3m_lines = None
 
@@ -1546,7 +2092,7 @@ def get_msa_and_templates(
     ):
         # find paired a3m if not a homooligomers
         if len(query_seqs_unique) > 1:
-            paired_a3m_lines = run_mmseqs2(
+            paired_a3m_lines = run_mmseqs2_throttled(
                 query_seqs_unique,
                 str(result_dir.joinpath(jobname)),
                 use_env,
@@ -1570,16 +2116,21 @@ def get_msa_and_templates(
         template_features,
     )
 
+@lru_cache(maxsize=1)
+def make_msa_features_from_a3m(a3m: str) -> Dict[str, ndarray]:
+    # queries are sorted by length, so a repeated query with the same msa usually directly follows and
+    # is not parsed again. the arrays are shared by the feature dicts of both jobs, nothing modifies them in place
+    return pipeline.make_msa_features([pipeline.parsers.parse_a3m(a3m)])
+
 def build_monomer_feature(
     sequence: str, unpaired_msa: str, template_features: Dict[str, Any]
 ):
-    msa = pipeline.parsers.parse_a3m(unpaired_msa)
     # gather features
     return {
         **pipeline.make_sequence_features(
             sequence=sequence, description="none", num_res=len(sequence)
         ),
-        **pipeline.make_msa_features([msa]),
+        **make_msa_features_from_a3m(unpaired_msa),
         **template_features,
     }
 
@@ -1631,11 +2182,11 @@ def process_multimer_features(
     )
     # merge_chain_features crashes if there are additional features only present in one chain
     # remove all features that are not present in all chains
-    common_features = set([*np_chains_list[0]]).intersection(*np_chains_list)
-    np_chains_list = [
-        {key: value for (key, value) in chain.items() if key in common_features}
-        for chain in np_chains_list
-    ]
+    # the chains are dicts built above (and by crop_chains), so the extra keys are deleted in place
+    common_features = set(np_chains_list[0]).intersection(*np_chains_list[1:])
+    for chain in np_chains_list:
+        for key in chain.keys() - common_features:
+            del chain[key]
     np_example = feature_processing.msa_pairing.merge_chain_features(
         np_chains_list=np_chains_list,
         pair_msa_sequences=pair_msa_sequences,
@@ -1658,11 +2209,11 @@ def pair_msa(
             unpaired_msa, query_seqs_unique, query_seqs_cardinality
         )
     elif paired_msa is not None and unpaired_msa is not None:
-        a3m_lines = (
-            pair_sequences(paired_msa, query_seqs_unique, query_seqs_cardinality)
-            + "\n"
-            + pad_sequences(unpaired_msa, query_seqs_unique, query_seqs_cardinality)
-        )
+        # one join copies both (possibly large) parts once, chained + would copy the paired part twice
+        a3m_lines = "\n".join([
+            pair_sequences(paired_msa, query_seqs_unique, query_seqs_cardinality),
+            pad_sequences(unpaired_msa, query_seqs_unique, query_seqs_cardinality),
+        ])
     elif paired_msa is not None and unpaired_msa is None:
         a3m_lines = pair_sequences(
             paired_msa, query_seqs_unique, query_seqs_cardinality
@@ -1698,8 +2249,13 @@ def generate_input_feature(
         a3m_lines += pair_msa(query_seqs_unique, query_seqs_cardinality, paired_msa, unpaired_msa)        
 
         input_feature = build_monomer_feature(full_sequence, a3m_lines, mk_mock_template(full_sequence))
-        input_feature["residue_index"] = np.concatenate([np.arange(L) for L in Ls])
-        input_feature["asym_id"] = np.concatenate([np.full(L,n) for n,L in enumerate(Ls)])
+        # per chain residue numbering and chain ids, built as whole arrays instead of one array per chain.
+        # int32 like the residue_index of build_monomer_feature
+        chain_starts = np.cumsum([0] + Ls[:-1])
+        input_feature["residue_index"] = (
+            np.arange(len(full_sequence), dtype=np.int32) - np.repeat(chain_starts, Ls).astype(np.int32)
+        )
+        input_feature["asym_id"] = np.repeat(np.arange(len(Ls), dtype=np.int32), Ls)
         if any(
             [
                 template != b"none"
@@ -1734,9 +2290,10 @@ def generate_input_feature(
                     input_msa = paired_msa[sequence_index]
                 feature_dict.update(build_multimer_feature(input_msa))
 
-            # for each copy
+            # for each copy, a shallow copy so every chain has its own dict while the (large) feature
+            # arrays are shared between the copies and must not be modified in place
             for cardinality in range(0, query_seqs_cardinality[sequence_index]):
-                features_for_chain[protein.PDB_CHAIN_IDS[chain_cnt]] = feature_dict
+                features_for_chain[protein.PDB_CHAIN_IDS[chain_cnt]] = feature_dict.copy()
                 chain_cnt += 1
 
         if "multimer" in model_type:
@@ -1762,6 +2319,62 @@ def generate_input_feature(
             }
     return (input_feature, domain_names)
 
+A3M_INSERTION_RUN_RE = re.compile(r"[a-z]+")
+A3M_MATCH_COLUMN_RE = re.compile(r"[^a-z]")
+
+def split_a3m_row(seq: str, query_seq_len: List[int]) -> Tuple[List[str], List[bool]]:
+    """splits an aligned row of a concatenated (paired) a3m into one segment per query chain and tells
+    which segments contain anything else than gaps. a segment has query_len match columns plus the
+    lower case insertions between them, insertions after its last match column go to the next one"""
+    stripped = seq.translate(A3M_INSERTIONS_TABLE)
+    if len(stripped) < sum(query_seq_len):
+        # truncated row, keep the behaviour of the character walk for it
+        return _split_a3m_row_by_char(seq, query_seq_len)
+    insertion_runs = [(m.start(), m.end()) for m in A3M_INSERTION_RUN_RE.finditer(seq)]
+    segments = []
+    has_amino_acid = []
+    start = 0
+    col = 0
+    run_ix = 0
+    inserted = 0
+    for query_len in query_seq_len:
+        col_end = col + query_len
+        # runs that sit in front of one of this segment's match columns belong to it
+        while run_ix < len(insertion_runs) and insertion_runs[run_ix][0] - inserted < col_end:
+            inserted += insertion_runs[run_ix][1] - insertion_runs[run_ix][0]
+            run_ix += 1
+        end = col_end + inserted
+        segments.append(seq[start:end])
+        has_amino_acid.append(stripped.count("-", col, col_end) < query_len)
+        start = end
+        col = col_end
+    return segments, has_amino_acid
+
+def _split_a3m_row_by_char(seq: str, query_seq_len: List[int]) -> Tuple[List[str], List[bool]]:
+    """split_a3m_row for rows with fewer match columns than the query. follows the former character walk,
+    a segment that runs into the end of the row does not move the start of the next segment"""
+    match_pos = [m.start() for m in A3M_MATCH_COLUMN_RE.finditer(seq)]
+    segments = []
+    has_amino_acid = []
+    start = 0
+    col = 0
+    for query_len in query_seq_len:
+        col_end = col + query_len
+        if query_len == 0:
+            end = start
+        elif col_end <= len(match_pos):
+            end = match_pos[col_end - 1] + 1
+        else:
+            end = len(seq)
+        segment = seq[start:end]
+        columns = segment.translate(A3M_INSERTIONS_TABLE)
+        segments.append(segment)
+        has_amino_acid.append(columns.count("-") < len(columns))
+        if end < len(seq):
+            start = end
+            col = col_end
+    return segments, has_amino_acid
+
 def unserialize_msa(
     a3m_lines: List[str], query_sequence: Union[List[str], str]
 ) -> Tuple[
@@ -1803,32 +2416,20 @@ def unserialize_msa(
             a3m_lines[2][prev_query_start : prev_query_start + query_len]
         )
         prev_query_start += query_len
-    paired_msa = [""] * len(query_seq_len)
-    unpaired_msa = [""] * len(query_seq_len)
-    already_in = dict()
+    # entries of every chain are collected in lists and joined once at the end, the parts of an
+    # entry are added separately so the rows are not copied into an intermediate string first
+    paired_msa = [[] for _ in query_seq_len]
+    unpaired_msa = [[] for _ in query_seq_len]
+    # the rows stay referenced by a3m_lines anyway and their string hashes are cached,
+    # so the tuples only add a small object per row
+    already_in = set()
     for i in range(1, len(a3m_lines), 2):
         header = a3m_lines[i]
         seq = a3m_lines[i + 1]
         if (header, seq) in already_in:
             continue
-        already_in[(header, seq)] = 1
-        has_amino_acid = [False] * len(query_seq_len)
-        seqs_line = []
-        prev_pos = 0
-        for n, query_len in enumerate(query_seq_len):
-            paired_seq = ""
-            curr_seq_len = 0
-            for pos in range(prev_pos, len(seq)):
-                if curr_seq_len == query_len:
-                    prev_pos = pos
-                    break
-                paired_seq += seq[pos]
-                if seq[pos].islower():
-                    continue
-                if seq[pos] != "-":
-                    has_amino_acid[n] = True
-                curr_seq_len += 1
-            seqs_line.append(paired_seq)
+        already_in.add((header, seq))
+        seqs_line, has_amino_acid = split_a3m_row(seq, query_seq_len)
 
         # is sequence is paired add them to output
         if (
@@ -1839,13 +2440,13 @@ def unserialize_msa(
             header_no_faster = header.replace(">", "")
             header_no_faster_split = header_no_faster.split("\t")
             for j in range(0, len(seqs_line)):
-                paired_msa[j] += ">" + header_no_faster_split[j] + "\n"
-                paired_msa[j] += seqs_line[j] + "\n"
+                paired_msa[j].extend((">", header_no_faster_split[j], "\n", seqs_line[j], "\n"))
         else:
             for j, seq in enumerate(seqs_line):
                 if has_amino_acid[j]:
-                    unpaired_msa[j] += header + "\n"
-                    unpaired_msa[j] += seq + "\n"
+                    unpaired_msa[j].extend((header, "\n", seq, "\n"))
+    paired_msa = ["".join(entries) for entries in paired_msa]
+    unpaired_msa = ["".join(entries) for entries in unpaired_msa]
     if is_homooligomer:
         # homooligomers
         num = 101
@@ -1873,22 +2474,35 @@ def msa_to_str(
     query_seqs_unique: List[str],
     query_seqs_cardinality: List[int],
 ) -> str:
-    msa = "#" + ",".join(map(str, map(len, query_seqs_unique))) + "\t"
-    msa += ",".join(map(str, query_seqs_cardinality)) + "\n"
+    query_seqs_len = ",".join(str(len(seq)) for seq in query_seqs_unique)
+    header = f"#{query_seqs_len}\t{','.join(map(str, query_seqs_cardinality))}\n"
     # build msa with cardinality of 1, it makes it easier to parse and manipulate
     query_seqs_cardinality = [1 for _ in query_seqs_cardinality]
-    msa += pair_msa(query_seqs_unique, query_seqs_cardinality, paired_msa, unpaired_msa)
-    return msa
+    msa = pair_msa(query_seqs_unique, query_seqs_cardinality, paired_msa, unpaired_msa)
+    # join the header and the msa body once instead of appending the large body to the header
+    return "".join((header, msa))
 
 
 global_fold_ids = {}
+# the models of the last run() keyed by their load_models_and_params arguments
+global_loaded_models = {}
 def get_fold_id(prefix:str):
-    if prefix in global_fold_ids: return global_fold_ids[prefix]
-
-    global_fold_ids[prefix] = str(uuid.uuid4())
-
-    return  global_fold_ids[prefix]
+    # setdefault is atomic, run() assigns the ids of its jobs before starting the msa threads
+    return global_fold_ids.setdefault(prefix, str(uuid.uuid4()))
+
+def restores_matmul_precision(func):
+    # run(matmul_precision=...) sets the precision for the whole process, a later call without it
+    # (e.g. the next job of serve_jobs) gets jax's setting back
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous_precision = getattr(jax.config, "jax_default_matmul_precision", None)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            jax.config.update("jax_default_matmul_precision", previous_precision)
+    return wrapper
 
+@restores_matmul_precision
 def run(
     queries: List[Tuple[str, Union[str, List[str]], Optional[List[str]]]],
     result_dir: Union[str, Path],
@@ -1912,6 +2526,7 @@ def run(
     num_seeds: int = 1,
     recompile_padding: Union[int, float] = 10,
     zip_results: bool = False,
+    deflate_zip: bool = False,
     prediction_callback: Callable[[Any, Any, Any, Any, Any], Any] = None,
     save_single_representations: bool = False,
     save_pair_representations: bool = False,
@@ -1925,8 +2540,19 @@ def run(
     max_extra_seq: Optional[int] = None,
     use_cluster_profile: bool = True,
     feature_dict_callback: Callable[[Any], Any] = None,
+    n_parallel_msa: int = 3,
+    n_parallel_msa_jobs: int = 4,
+    use_pad_buckets: bool = True,
+    save_distogram: bool = False,
+    matmul_precision: Optional[str] = None,
+    config_filename: str = "config.json",
+    max_msa_server_searches: int = MAX_MSA_SERVER_SEARCHES,
     **kwargs
 ):
+
+    # the plotting imports are warmed up while the device and the models are set up
+    Thread(target=warm_up_plotting, daemon=True).start()
+
     # check what device is available
     try:
         # check if TPU is available
@@ -1948,11 +2574,12 @@ def run(
             # disable GPU on tensorflow
             tf.config.set_visible_devices([], 'GPU')
 
-    from alphafold.notebooks.notebook_utils import get_pae_json
     from colabfold.alphafold.models import load_models_and_params
-    from colabfold.colabfold import plot_paes, plot_plddts
-    from colabfold.plot import plot_msa_v2
-    from colabfold.plot import plot_msa_v3
+
+    # the float32 matmuls without an explicit precision run on the tensor cores of ampere and newer gpus
+    # with tensorfloat32 or bfloat16. left alone by default, so the results stay reproducible
+    if matmul_precision is not None:
+        jax.config.update("jax_default_matmul_precision", MATMUL_PRECISIONS[matmul_precision])
 
     data_dir = Path(data_dir)
     result_dir = Path(result_dir)
@@ -2054,14 +2681,16 @@ def run(
         "random_seed": random_seed,
         "num_seeds": num_seeds,
         "recompile_padding": recompile_padding,
+        "use_pad_buckets": use_pad_buckets,
         "commit": get_commit(),
         "use_dropout": use_dropout,
         "use_cluster_profile": use_cluster_profile,
         "use_fuse": use_fuse,
         "use_bfloat16":use_bfloat16,
+        "matmul_precision": matmul_precision,
         "version": importlib_metadata.version("colabfold"),
     }
-    config_out_file = result_dir.joinpath("config.json")
+    config_out_file = result_dir.joinpath(config_filename)
     config_out_file.write_text(json.dumps(config, indent=4))
     use_env = "env" in msa_mode
     use_msa = "mmseqs2" in msa_mode
@@ -2076,47 +2705,140 @@ def run(
 
     pad_len = 0
     ranks, metrics = [],[]
+
+    # the fold ids are assigned here so the msa threads only read them, predict_structure gets the same ids.
+    # a job of an earlier run() in this process with the same name gets a new id
+    global_fold_ids.clear()
+    fold_ids = {
+        safe_filename(raw_jobname): get_fold_id(safe_filename(raw_jobname))
+        for raw_jobname, query_sequence, a3m_lines in queries
+    }
     
-    msa_data_store = {}
-    def fetch_msas_in_background(queries,result_dir,keep_existing_results,use_templates,get_msa_and_templates,msa_to_str, unserialize_msa,logger,data_store, template_store, unpaired_msa_store):
-        
-        for job_number, (raw_jobname, query_sequence, a3m_lines) in enumerate(queries):
-            jobname = safe_filename(raw_jobname)
-            is_done_marker = result_dir.joinpath(jobname + ".done.txt")
-            if keep_existing_results and is_done_marker.is_file():
-                logger.info(f"Skipping {jobname} (already done)")
-                continue
-            try:
-                if use_templates or a3m_lines is None:
-                    data_store[jobname] = get_msa_and_templates_v3(jobname, query_sequence, result_dir, msa_mode, use_templates, custom_template_path, pair_mode, host_url, template_store, unpaired_msa_store)
-                if a3m_lines is not None:
-                    (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features_) \
-                    = unserialize_msa(a3m_lines, query_sequence)
-                    data_store[jobname] = (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features_)
-                    if not use_templates: template_features = template_features_
-                # save a3m
-                (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features) = data_store[jobname]
-                msa = msa_to_str(unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality)
-                msa_filename = str(result_dir.joinpath(f"{jobname}.a3m.xz"))
-                last_line_len = len(msa.split("\n").pop())
-
-                datetimestr = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S') + " UTC"
-                fold_id = get_fold_id(jobname)
-                msa += f"\n>NON_MSA_FILE_METADATA_LINE  fold_id={fold_id}  gen_time={datetimestr}"#+"X"*last_line_len
-                with lzma.open(msa_filename, 'wb') as handle:
-                    handle.write(msa.encode("utf-8"))
-            except Exception as e:
-                logger.exception(f"Could not generate MSA for {jobname}: {e}")
-                data_store[jobname] = 'error'
-                continue
-    
-    msa_bg_thread = Thread(target=fetch_msas_in_background, args=(queries,result_dir,keep_existing_results,use_templates,get_msa_and_templates,msa_to_str, unserialize_msa,logger, msa_data_store,saved_template_paths, saved_unpaired_msa_paths))
-    msa_bg_thread.start()
+    def fetch_msa(jobname, query_sequence, a3m_lines):
+        try:
+            msa_data = None
+            if use_templates or a3m_lines is None:
+                msa_data = get_msa_and_templates_v3(jobname, query_sequence, result_dir, msa_mode, use_templates, custom_template_path, pair_mode, host_url, saved_template_paths, saved_unpaired_msa_paths, n_parallel_msa, max_msa_server_searches)
+            if a3m_lines is not None:
+                # the given a3m replaces the searched msa, searched templates are kept
+                a3m_data = unserialize_msa(a3m_lines, query_sequence)
+                if msa_data is not None:
+                    a3m_data = a3m_data[:4] + msa_data[4:]
+                msa_data = a3m_data
+            # save a3m
+            (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features) = msa_data
+            msa = msa_to_str(unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality)
+            msa_filename = str(result_dir.joinpath(f"{jobname}.a3m.xz"))
+
+            datetimestr = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S') + " UTC"
+            fold_id = fold_ids[jobname]
+            metadata_line = f"\n>NON_MSA_FILE_METADATA_LINE  fold_id={fold_id}  gen_time={datetimestr}"
+            _write_lzma_text(msa_filename, [msa, metadata_line])
+            return msa_data
+        except Exception as e:
+            logger.exception(f"Could not generate MSA for {jobname}: {e}")
+            return None
+
+    # the msa server requests are network bound, so several queries are fetched at once while the
+    # main loop predicts. futures are indexed by job number, job names do not have to be unique
+    msa_executor = ThreadPoolExecutor(max_workers=max(1, n_parallel_msa_jobs))
+    msa_futures = [None] * len(queries)
+    # the unpaired msas and templates of all queries are first searched in a few batched requests,
+    # the server handles a batch about as fast as a single query. the batches are searched one after
+    # another and the msa of a job is fetched as soon as the batches with its chains are done
+    prefetch_executor = ThreadPoolExecutor(max_workers=1)
+    queries_to_search = [
+        query_sequence for raw_jobname, query_sequence, a3m_lines in queries
+        if (use_templates or a3m_lines is None)
+        and not (keep_existing_results and result_dir.joinpath(safe_filename(raw_jobname) + ".done.txt").is_file())
+    ]
+    prefetch_batches = plan_msa_prefetch(
+        queries_to_search, msa_mode, use_templates, pair_mode, saved_template_paths, saved_unpaired_msa_paths
+    )
+    prefetch_futures = {}
+    for batch in prefetch_batches:
+        batch_future = prefetch_executor.submit(
+            prefetch_msa_batch, batch, result_dir, msa_mode, use_templates, custom_template_path,
+            host_url, saved_template_paths, saved_unpaired_msa_paths, max_msa_server_searches,
+        )
+        for seq in batch:
+            prefetch_futures[seq] = batch_future
+    for job_number, (raw_jobname, query_sequence, a3m_lines) in enumerate(queries):
+        jobname = safe_filename(raw_jobname)
+        if keep_existing_results and result_dir.joinpath(jobname + ".done.txt").is_file():
+            continue
+        query_chains = [query_sequence] if isinstance(query_sequence, str) else query_sequence
+        batch_futures = [prefetch_futures[seq] for seq in query_chains if seq in prefetch_futures] \
+            if use_templates or a3m_lines is None else []
+        msa_futures[job_number] = submit_after(msa_executor, batch_futures, fetch_msa, jobname, query_sequence, a3m_lines)
     
+    def prepare_features(job_number, jobname):
+        ###########################################
+        # generate MSA (a3m_lines) and templates
+        ###########################################
+        try:
+            msa_future = msa_futures[job_number]
+            # drop the reference, the msa data is only needed until the features are built
+            msa_futures[job_number] = None
+            if not msa_future.done():
+                logger.info(f"WAITING ON MSA for {jobname}")
+            msa_data = msa_future.result()
+
+            if msa_data is None:
+                logger.info(f"ERROR: Could not get MSA for {jobname} have to skip")
+                raise RuntimeError(f"MSA retrieval failed for {jobname}")
+            (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features) = msa_data
+        except Exception as e:
+            logger.exception(f"Could not get MSA/templates for {jobname}: {e}")
+            return None
+
+        #######################
+        # generate features
+        #######################
+        try:
+            (feature_dict, domain_names) \
+            = generate_input_feature(query_seqs_unique, query_seqs_cardinality, unpaired_msa, paired_msa,
+                                     template_features, is_complex, model_type, max_seq=max_seq)
+        except Exception as e:
+            logger.exception(f"Could not generate input features {jobname}: {e}")
+            return None
+        return feature_dict, domain_names, query_seqs_unique, query_seqs_cardinality
+
+    # the a3m parsing and feature generation of the next job run on a worker while the current
+    # job is predicted. only one job ahead, the features are several times larger than the msa text
+    feature_executor = ThreadPoolExecutor(max_workers=1)
+    feature_futures = {}
+    # the outputs of predict_structure and finish_job are written here, shut down at the end of the run
+    io_pool = ThreadPoolExecutor(max_workers=IO_POOL_WORKERS)
+
+    def submit_next_features(job_number):
+        for next_number in range(job_number + 1, len(queries)):
+            if msa_futures[next_number] is not None:
+                next_jobname = safe_filename(queries[next_number][0])
+                feature_futures[next_number] = feature_executor.submit(prepare_features, next_number, next_jobname)
+                return
+
+    def finish_job(feature_dict, coverage_png, result_files, result_zip, is_done_marker):
+        # make msa plot, the plotting module is imported here on the io pool and not on the main thread
+        from colabfold.plot import save_msa_plot_v3
+        save_msa_plot_v3(feature_dict, str(coverage_png), dpi=300)
+
+        if zip_results:
+            write_result_zip(result_zip, result_files, deflate_zip)
+            
+            # Delete only after the zip was successful, and also not the bibtex and config because we need those again
+            for file in result_files[:-2]:
+                file.unlink()
+        else:
+            is_done_marker.touch()
+
+    # the msa plot, zip and done marker of a job are finished on the io pool while the next job is predicted
+    finished_jobs = []
+
     first_job = True
     for job_number, (raw_jobname, query_sequence, a3m_lines) in enumerate(queries):
         jobname = safe_filename(raw_jobname)
-        (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features) = None, None, None, None, None
+        feature_future = feature_futures.pop(job_number, None)
         
         #######################################
         # check if job has already finished
@@ -2135,61 +2857,41 @@ def run(
         seq_len = len("".join(query_sequence))
         logger.info(f"Query {job_number + 1}/{len(queries)}: {jobname} (length {seq_len})")
 
-        ###########################################
-        # generate MSA (a3m_lines) and templates
-        ###########################################
-        try:
-            if use_templates or a3m_lines is None:
-
-                while jobname not in msa_data_store:
-                    logger.info(f"WAITING ON MSA for {jobname}, sleeping for 10s")
-                    time.sleep(10)
-
-                if msa_data_store[jobname] is None or msa_data_store[jobname] == 'error':
-                    logger.info(f"ERROR: Could not get MSA for {jobname} have to skip")
-                    raise RuntimeError(f"MSA retrieval failed for {jobname}")
-                else:
-                    (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features) = msa_data_store.pop(jobname, None)
-
-            if a3m_lines is not None:
-                (unpaired_msa, paired_msa, query_seqs_unique, query_seqs_cardinality, template_features_) \
-                = unserialize_msa(a3m_lines, query_sequence)
-                if not use_templates: template_features = template_features_
-        except Exception as e:
-            logger.exception(f"Could not get MSA/templates for {jobname}: {e}")
+        if feature_future is None:
+            feature_future = feature_executor.submit(prepare_features, job_number, jobname)
+        submit_next_features(job_number)
+        features = feature_future.result()
+        if features is None:
             continue
+        (feature_dict, domain_names, query_seqs_unique, query_seqs_cardinality) = features
 
-        #######################
-        # generate features
-        #######################
-        try:
-
-            (feature_dict, domain_names) \
-            = generate_input_feature(query_seqs_unique, query_seqs_cardinality, unpaired_msa, paired_msa,
-                                     template_features, is_complex, model_type, max_seq=max_seq)
-            
-            # to allow display of MSA info during colab/chimera run (thanks tomgoddard)
-            if feature_dict_callback is not None:
+        # to allow display of MSA info during colab/chimera run (thanks tomgoddard)
+        if feature_dict_callback is not None:
+            try:
                 feature_dict_callback(feature_dict)
-        
-        except Exception as e:
-            logger.exception(f"Could not generate input features {jobname}: {e}")
-            continue
+            except Exception as e:
+                logger.exception(f"Could not generate input features {jobname}: {e}")
+                continue
         
         ######################
         # predict structures
         ######################
         try:
             # get list of lengths
-            query_sequence_len_array = sum([[len(x)] * y 
-                for x,y in zip(query_seqs_unique, query_seqs_cardinality)],[])
+            query_sequence_len_array = list(itertools.chain.from_iterable(
+                [len(x)] * y for x,y in zip(query_seqs_unique, query_seqs_cardinality)))
             
-            # decide how much to pad (to avoid recompiling)
-            if seq_len > pad_len:
+            # decide how much to pad (to avoid recompiling). the padding only grows, except with buckets when
+            # the query falls into a smaller bucket, e.g. the first complex after the longer monomers
+            shrink_pad_len = use_pad_buckets and bucket_pad_len(seq_len) < bucket_pad_len(pad_len)
+            if seq_len > pad_len or shrink_pad_len:
                 if isinstance(recompile_padding, float):
                     pad_len = math.ceil(seq_len * recompile_padding)
                 else:
                     pad_len = seq_len + recompile_padding
+                # queries are sorted by length, so consecutive queries in one bucket reuse the compiled model
+                if use_pad_buckets:
+                    pad_len = max(pad_len, bucket_pad_len(seq_len))
                 pad_len = min(pad_len, max_len)
                             
             # prep model and params
@@ -2209,7 +2911,7 @@ def run(
                     max_extra_seq = max(min(num_seqs - max_seq, max_extra_seq), 1)
                     logger.info(f"Setting max_seq={max_seq}, max_extra_seq={max_extra_seq}")
 
-                model_runner_and_params = load_models_and_params(
+                model_args = dict(
                     num_models=num_models,
                     use_templates=use_templates,
                     num_recycles=num_recycles,
@@ -2228,37 +2930,64 @@ def run(
                     use_bfloat16=use_bfloat16,
                     save_all=save_all,
                 )
+                # a later run() in the same process with the same settings reuses the loaded models
+                # and their compiled functions
+                model_key = tuple((k, tuple(v) if isinstance(v, list) else v) for k, v in model_args.items())
+                model_runner_and_params = global_loaded_models.get(model_key)
+                if model_runner_and_params is None:
+                    # only one set of models is kept in memory
+                    global_loaded_models.clear()
+                    model_runner_and_params = load_models_and_params(**model_args)
+                    global_loaded_models[model_key] = model_runner_and_params
                 first_job = False
 
-            results = predict_structure(
-                prefix=jobname,
-                result_dir=result_dir,
-                feature_dict=feature_dict,
-                is_complex=is_complex,
-                use_templates=use_templates,
-                template_domains=domain_names,
-                sequences_lengths=query_sequence_len_array,
-                pad_len=pad_len,
-                model_type=model_type,
-                model_runner_and_params=model_runner_and_params,
-                num_relax=num_relax,
-                rank_by=rank_by,
-                stop_at_score=stop_at_score,
-                prediction_callback=prediction_callback,
-                use_gpu_relax=use_gpu_relax,
-                random_seed=random_seed,
-                num_seeds=num_seeds,
-                save_all=save_all,
-                save_single_representations=save_single_representations,
-                save_pair_representations=save_pair_representations,
-                save_recycles=save_recycles,
-            )
+            # an out of memory error is retried once without the padding, so the msa isn't wasted
+            for attempt in range(2):
+                try:
+                    results = predict_structure(
+                        prefix=jobname,
+                        result_dir=result_dir,
+                        feature_dict=feature_dict,
+                        is_complex=is_complex,
+                        use_templates=use_templates,
+                        template_domains=domain_names,
+                        sequences_lengths=query_sequence_len_array,
+                        pad_len=pad_len,
+                        model_type=model_type,
+                        model_runner_and_params=model_runner_and_params,
+                        num_relax=num_relax,
+                        rank_by=rank_by,
+                        stop_at_score=stop_at_score,
+                        prediction_callback=prediction_callback,
+                        use_gpu_relax=use_gpu_relax,
+                        random_seed=random_seed,
+                        num_seeds=num_seeds,
+                        save_all=save_all,
+                        save_single_representations=save_single_representations,
+                        save_pair_representations=save_pair_representations,
+                        save_recycles=save_recycles,
+                        save_distogram=save_distogram,
+                        config_filename=config_filename,
+                        io_pool=io_pool,
+                    )
+                    break
+                except RuntimeError as e:
+                    # multimer inputs are never padded, retrying them would only repeat the failure
+                    is_padded = "multimer" not in model_type and pad_len > seq_len
+                    if attempt > 0 or not is_padded or not is_out_of_memory(e):
+                        raise
+                    logger.warning(f"Not enough GPU memory to predict {jobname} padded to {pad_len}, "
+                                   f"retrying padded to its length {seq_len}")
+                    # frees the compiled models of the failed length
+                    if hasattr(jax, "clear_caches"):
+                        jax.clear_caches()
+                    pad_len = seq_len
             result_files = results["result_files"]
             ranks.append(results["rank"])
             metrics.append(results["metric"])
 
         except RuntimeError as e:
-            # This normally happens on OOM. TODO: Filter for the specific OOM error message
+            # This normally happens on OOM, also after the retry without padding
             logger.error(f"Could not predict {jobname}. Not Enough GPU memory? {e}")
             continue
 
@@ -2266,11 +2995,8 @@ def run(
         # save plots
         ###############
 
-        # make msa plot
-        msa_plot = plot_msa_v3(feature_dict, dpi=300)
+        # the msa plot is made by finish_job on the io pool
         coverage_png = result_dir.joinpath(f"{jobname}_coverage.png")
-        msa_plot.savefig(str(coverage_png), bbox_inches='tight')
-        msa_plot.close()
         result_files.append(coverage_png)
 
         # load the scores
@@ -2312,29 +3038,33 @@ def run(
         result_files.append(result_dir.joinpath(jobname + ".a3m"))
         result_files += [bibtex_file, config_out_file]
 
-        if zip_results:
-            with zipfile.ZipFile(result_zip, "w") as result_zip:
-                for file in result_files:
-                    result_zip.write(file, arcname=file.name)
-            
-            # Delete only after the zip was successful, and also not the bibtex and config because we need those again
-            for file in result_files[:-2]:
-                file.unlink()
-        else:
-            is_done_marker.touch()
+        finished_jobs.append(
+            io_pool.submit(finish_job, feature_dict, coverage_png, result_files, result_zip, is_done_marker)
+        )
             
-    msa_bg_thread.join()
+    # all background plotting and zipping is finished before the executors are shut down
+    io_pool.shutdown(wait=True)
+    feature_executor.shutdown(wait=True)
+    # the last batches submit their jobs to the msa executor, so it is shut down after them
+    prefetch_executor.shutdown(wait=True)
+    msa_executor.shutdown(wait=True)
+    # errors of the background plotting and zipping surface here
+    for finished_job in finished_jobs:
+        finished_job.result()
+    # release the msa features of the last job
+    make_msa_features_from_a3m.cache_clear()
     logger.info("Done")
     return {"rank":ranks,"metric":metrics}
 
+# backward-compatibility with old options
+OLD_MODEL_TYPE_NAMES = {"AlphaFold2-multimer-v1":"alphafold2_multimer_v1",
+                        "AlphaFold2-multimer-v2":"alphafold2_multimer_v2",
+                        "AlphaFold2-multimer-v3":"alphafold2_multimer_v3",
+                        "AlphaFold2-ptm":        "alphafold2_ptm",
+                        "AlphaFold2":            "alphafold2"}
+
 def set_model_type(is_complex: bool, model_type: str) -> str:
-    # backward-compatibility with old options
-    old_names = {"AlphaFold2-multimer-v1":"alphafold2_multimer_v1",
-                 "AlphaFold2-multimer-v2":"alphafold2_multimer_v2",
-                 "AlphaFold2-multimer-v3":"alphafold2_multimer_v3",
-                 "AlphaFold2-ptm":        "alphafold2_ptm",
-                 "AlphaFold2":            "alphafold2"}
-    model_type = old_names.get(model_type, model_type)
+    model_type = OLD_MODEL_TYPE_NAMES.get(model_type, model_type)
     if model_type == "auto":
         if is_complex:
             model_type = "alphafold2_multimer_v3"
@@ -2342,6 +3072,69 @@ def set_model_type(is_complex: bool, model_type: str) -> str:
             model_type = "alphafold2_ptm"
     return model_type
 
+def run_on_gpus(num_gpus: int, argv: List[str]) -> int:
+    """Runs one colabfold_batch process per GPU, each pinned to its device and predicting every
+    num_gpus-th query. argv are the arguments of this process without --parallel-gpus.
+    Returns the first non-zero exit code of the processes, or 0."""
+    import subprocess
+
+    # the device is pinned in the environment of the process, so it is set before jax is imported there
+    processes = [
+        subprocess.Popen([sys.executable, "-m", "colabfold.batch", *argv, "--query-shard", f"{gpu}/{num_gpus}"],
+                         env={**os.environ, "CUDA_VISIBLE_DEVICES": str(gpu)})
+        for gpu in range(num_gpus)
+    ]
+    return_codes = [process.wait() for process in processes]
+    return next((code for code in return_codes if code != 0), 0)
+
+def strip_parallel_gpus(argv: List[str]) -> List[str]:
+    stripped = []
+    skip_value = False
+    for arg in argv:
+        if skip_value:
+            skip_value = False
+        elif arg == "--parallel-gpus":
+            skip_value = True
+        elif not arg.startswith("--parallel-gpus="):
+            stripped.append(arg)
+    return stripped
+
+def serve_jobs(socket_path: str, run_input: Callable[[str, str], Any]):
+    """Takes jobs on a unix socket until it is asked to shut down. The process keeps the loaded models
+    and compiled functions, so a job does not pay the startup of a new colabfold_batch process.
+    Jobs run one at a time, every connection sends one json line and receives one json line."""
+    import socket
+
+    # a socket left behind by an earlier server is replaced, anything else at the path is kept
+    if os.path.lexists(socket_path):
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            raise FileExistsError(f"{socket_path} exists and is not a socket")
+        os.remove(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(socket_path)
+        server.listen()
+        logger.info(f"Waiting for jobs on {socket_path}")
+        while True:
+            connection, _ = server.accept()
+            with connection, connection.makefile("rw") as stream:
+                shutdown = False
+                try:
+                    job = json.loads(stream.readline())
+                    if job.get("shutdown"):
+                        shutdown = True
+                    else:
+                        logger.info(f"Received job {job['input']} -> {job['results']}")
+                        run_input(job["input"], job["results"])
+                    reply = {"status": "ok"}
+                except Exception as e:
+                    logger.exception(f"Job failed: {e}")
+                    reply = {"status": "error", "message": str(e)}
+                stream.write(json.dumps(reply) + "\n")
+                stream.flush()
+            if shutdown:
+                break
+    os.remove(socket_path)
+
 def main():
     parser = ArgumentParser()
     parser.add_argument("input",
@@ -2407,6 +3200,24 @@ def main():
         ],
         help="Using an a3m file as input overwrites this option",
     )
+    parser.add_argument("--n-parallel-msa",
+        help="Number of MMseqs2 searches (templates, unpaired and paired MSA) of a query to run concurrently. "
+        "Set to 1 to run them one after another.",
+        type=int,
+        default=3,
+    )
+    parser.add_argument("--n-parallel-msa-jobs",
+        help="Number of queries whose MSAs and templates are fetched concurrently while predicting. "
+        "Each of them runs up to --n-parallel-msa searches.",
+        type=int,
+        default=4,
+    )
+    parser.add_argument("--max-msa-server-searches",
+        help="Number of searches on the MSA server that run at once, over all queries fetched concurrently. "
+        "Please keep this low on the public server.",
+        type=int,
+        default=MAX_MSA_SERVER_SEARCHES,
+    )
     parser.add_argument("--saved-template-features-path", default="colabfold_template_store", type=str)
     parser.add_argument("--saved-unpaired-msa-path", default="colabfold_unpaired_msa_store", type=str)
     parser.add_argument("--model-type",
@@ -2453,10 +3264,10 @@ def main():
         choices=["unpaired", "paired", "unpaired_paired"],
     )
     parser.add_argument("--sort-queries-by",
-        help="sort queries by: none, length, random",
+        help="sort queries by: none, length, bucket (padded length, keeping the input order within a bucket), random",
         type=str,
         default="length",
-        choices=["none", "length", "random"],
+        choices=["none", "length", "bucket", "random"],
     )
     parser.add_argument("--save-single-representations",
         default=False,
@@ -2468,6 +3279,11 @@ def main():
         action="store_true",
         help="saves the pair representation embeddings of all models",
     )
+    parser.add_argument("--save-distogram",
+        default=False,
+        action="store_true",
+        help="saves the distogram bin probabilities (in percent) of every residue pair and their maximum as json",
+    )
     parser.add_argument("--use-dropout",
         default=False,
         action="store_true",
@@ -2493,15 +3309,34 @@ def main():
         action="store_true",
         help="EXPERIMENTAL: for multimer models, disable cluster profiles",
     )
+    parser.add_argument("--disable-pad-buckets",
+        default=False,
+        action="store_true",
+        help="Pad only by --recompile-padding instead of rounding the length up to fixed buckets "
+        "(128, 256, 384, 512, then multiples of 128 but at most 10%% longer), "
+        "which recompiles more often but predicts shorter inputs.",
+    )
     parser.add_argument("--zip",
         default=False,
         action="store_true",
         help="zip all results into one <jobname>.result.zip and delete the original files",
     )
-    parser.add_argument("--use-gpu-relax",
+    parser.add_argument("--zip-deflate",
         default=False,
         action="store_true",
-        help="run amber on GPU instead of CPU",
+        help="compress the uncompressed results (pickles, npy and pdb files) in the --zip archives, "
+        "which makes them smaller but costs cpu time",
+    )
+    parser.add_argument("--use-gpu-relax",
+        default=None,
+        action="store_true",
+        help="run amber on GPU instead of CPU. By default the GPU is used when openmm finds a CUDA device",
+    )
+    parser.add_argument("--use-cpu-relax",
+        dest="use_gpu_relax",
+        default=None,
+        action="store_false",
+        help="run amber on CPU even if a CUDA device is available",
     )
     parser.add_argument("--save-all",
         default=False,
@@ -2519,15 +3354,96 @@ def main():
         action="store_true",
         help="if you are getting tensorflow/jax errors it might help to disable this",
     )
+    parser.add_argument("--mem-fraction",
+        default=None,
+        type=float,
+        help="Fraction of the GPU memory jax may use (XLA_PYTHON_CLIENT_MEM_FRACTION). "
+        "Values above 1 spill into host memory with unified memory. Defaults to 4.0, or jax's default "
+        "with --disable-unified-memory",
+    )
+    parser.add_argument("--jax-cache-dir",
+        default=os.environ.get("COLABFOLD_JAX_CACHE"),
+        type=str,
+        help="Keep the compiled models in this directory, so a later run with the same padded lengths "
+        "skips the compilation. The directory is not cleaned up. Defaults to $COLABFOLD_JAX_CACHE, off if unset",
+    )
+    parser.add_argument("--matmul-precision",
+        default=None,
+        choices=list(MATMUL_PRECISIONS),
+        help="Precision of the float32 matrix multiplications in the model: highest (float32), "
+        "high (tensorfloat32) or medium (bfloat16). high and medium use the tensor cores of newer GPUs "
+        "and are faster, but change the results slightly. Defaults to jax's setting",
+    )
+    parser.add_argument("--server",
+        default=None,
+        type=str,
+        help="After the input, keep running and take further jobs on this unix socket, reusing the loaded "
+        "models. Each connection sends one json line {\"input\": ..., \"results\": ...} and receives "
+        "one json line when the job is done, {\"shutdown\": true} stops the server",
+    )
+    parser.add_argument("--gpu-device",
+        default=None,
+        type=int,
+        help="Run on this GPU only, by setting CUDA_VISIBLE_DEVICES before jax initializes its devices. "
+        "Setting CUDA_VISIBLE_DEVICES in the environment is the more reliable way",
+    )
+    parser.add_argument("--parallel-gpus",
+        default=None,
+        type=int,
+        help="Run one process per GPU on this many GPUs, the sorted queries are distributed round-robin",
+    )
+    parser.add_argument("--query-shard",
+        default=None,
+        type=str,
+        help="I/N: only predict every N-th query starting at the I-th (counting from 0) "
+        "of the sorted queries. Used by --parallel-gpus",
+    )
 
     args = parser.parse_args()
+
+    data_dir = Path(args.data or default_data_dir)
+
+    # the processes of a shard write their own log and config, the results of the shards share a directory
+    query_shard = None
+    log_filename, config_filename = "log.txt", "config.json"
+    if args.query_shard is not None:
+        try:
+            shard_index, shard_count = (int(i) for i in args.query_shard.split("/"))
+        except ValueError:
+            parser.error("--query-shard must be I/N")
+        if not 0 <= shard_index < shard_count:
+            parser.error("--query-shard must be I/N with 0 <= I < N")
+        query_shard = slice(shard_index, None, shard_count)
+        log_filename, config_filename = f"log_shard{shard_index}.txt", f"config_shard{shard_index}.json"
+
+    if args.parallel_gpus is not None:
+        if args.gpu_device is not None or args.query_shard is not None or args.server is not None:
+            parser.error("--parallel-gpus can't be combined with --gpu-device, --query-shard or --server")
+        if args.parallel_gpus < 1:
+            parser.error("--parallel-gpus must be at least 1")
+        setup_logging(Path(args.results).joinpath(log_filename))
+        # the params are downloaded once here, otherwise all processes would download and extract
+        # them into the same directory at once. the processes then find the download marker
+        queries, is_complex = get_queries(args.input, "none")
+        download_alphafold_params(set_model_type(is_complex, args.model_type), data_dir)
+        sys.exit(run_on_gpus(args.parallel_gpus, strip_parallel_gpus(sys.argv[1:])))
+
+    # jax was imported already, this only works as long as nothing has used a device yet.
+    # --parallel-gpus sets CUDA_VISIBLE_DEVICES in the environment of its processes instead
+    if args.gpu_device is not None:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(args.gpu_device)
     
     # disable unified memory
     if args.disable_unified_memory:
         for k in ENV.keys():
             if k in os.environ: del os.environ[k]
+    if args.mem_fraction is not None:
+        os.environ["XLA_PYTHON_CLIENT_MEM_FRACTION"] = str(args.mem_fraction)
 
-    setup_logging(Path(args.results).joinpath("log.txt"))
+    setup_logging(Path(args.results).joinpath(log_filename))
+
+    if args.jax_cache_dir:
+        enable_compilation_cache(args.jax_cache_dir)
 
     version = importlib_metadata.version("colabfold")
     commit = get_commit()
@@ -2535,18 +3451,11 @@ def main():
         version += f" ({commit})"
 
     logger.info(f"Running colabfold {version}")
-
-    data_dir = Path(args.data or default_data_dir)
-
-    queries, is_complex = get_queries(args.input, args.sort_queries_by)
-    model_type = set_model_type(is_complex, args.model_type)
-        
-    download_alphafold_params(model_type, data_dir)
-
-    if args.msa_mode != "single_sequence" and not args.templates:
-        uses_api = any((query[2] is None for query in queries))
-        if uses_api and args.host_url == DEFAULT_API_SERVER:
-            print(ACCEPT_DEFAULT_TERMS, file=sys.stderr)
+    logger.info(
+        f"GPU memory: unified memory {'on' if os.environ.get('TF_FORCE_UNIFIED_MEMORY') == '1' else 'off'}, "
+        f"preallocation {'off' if os.environ.get('XLA_PYTHON_CLIENT_PREALLOCATE') == 'false' else 'on'}, "
+        f"fraction {os.environ.get('XLA_PYTHON_CLIENT_MEM_FRACTION', 'default')}"
+    )
 
     model_order = [int(i) for i in args.model_order.split(",")]
 
@@ -2556,43 +3465,80 @@ def main():
     if args.amber and args.num_relax == 0:
         args.num_relax = args.num_models * args.num_seeds
 
-    run(
-        queries=queries,
-        result_dir=args.results,
-        use_templates=args.templates,
-        custom_template_path=args.custom_template_path,
-        num_relax=args.num_relax,
-        msa_mode=args.msa_mode,
-        model_type=model_type,
-        num_models=args.num_models,
-        num_recycles=args.num_recycle,
-        recycle_early_stop_tolerance=args.recycle_early_stop_tolerance,
-        num_ensemble=args.num_ensemble,
-        model_order=model_order,
-        is_complex=is_complex,
-        keep_existing_results=not args.overwrite_existing_results,
-        rank_by=args.rank,
-        pair_mode=args.pair_mode,
-        data_dir=data_dir,
-        host_url=args.host_url,
-        random_seed=args.random_seed,
-        num_seeds=args.num_seeds,
-        stop_at_score=args.stop_at_score,
-        recompile_padding=args.recompile_padding,
-        zip_results=args.zip,
-        save_single_representations=args.save_single_representations,
-        save_pair_representations=args.save_pair_representations,
-        use_dropout=args.use_dropout,
-        max_seq=args.max_seq,
-        max_extra_seq=args.max_extra_seq,
-        max_msa=args.max_msa,
-        use_cluster_profile=not args.disable_cluster_profile,
-        use_gpu_relax = args.use_gpu_relax,
-        save_all=args.save_all,
-        save_recycles=args.save_recycles,
-        saved_template_paths = args.saved_template_features_path,
-        saved_unpaired_msa_paths = args.saved_unpaired_msa_path
-    )
+    # openmm is only asked for a CUDA device when something is relaxed
+    if args.use_gpu_relax is None:
+        args.use_gpu_relax = args.num_relax > 0 and openmm_cuda_available()
+        if args.num_relax > 0:
+            logger.info(f"Relaxing on {'GPU' if args.use_gpu_relax else 'CPU'}")
+
+    def run_input(input_path, result_dir):
+        if query_shard is not None and args.sort_queries_by == "random":
+            # every shard has to shuffle the queries the same way
+            queries, is_complex = get_queries(input_path, "none")
+            random.Random(args.random_seed).shuffle(queries)
+        else:
+            queries, is_complex = get_queries(input_path, args.sort_queries_by)
+        # the model type is still picked from all queries, so all shards use the same models
+        model_type = set_model_type(is_complex, args.model_type)
+        if query_shard is not None:
+            queries = queries[query_shard]
+
+        download_alphafold_params(model_type, data_dir)
+
+        if args.msa_mode != "single_sequence" and not args.templates:
+            uses_api = any((query[2] is None for query in queries))
+            if uses_api and args.host_url == DEFAULT_API_SERVER:
+                print(ACCEPT_DEFAULT_TERMS, file=sys.stderr)
+
+        return run(
+            queries=queries,
+            result_dir=result_dir,
+            use_templates=args.templates,
+            custom_template_path=args.custom_template_path,
+            num_relax=args.num_relax,
+            msa_mode=args.msa_mode,
+            model_type=model_type,
+            num_models=args.num_models,
+            num_recycles=args.num_recycle,
+            recycle_early_stop_tolerance=args.recycle_early_stop_tolerance,
+            num_ensemble=args.num_ensemble,
+            model_order=model_order,
+            is_complex=is_complex,
+            keep_existing_results=not args.overwrite_existing_results,
+            rank_by=args.rank,
+            pair_mode=args.pair_mode,
+            data_dir=data_dir,
+            host_url=args.host_url,
+            random_seed=args.random_seed,
+            num_seeds=args.num_seeds,
+            stop_at_score=args.stop_at_score,
+            recompile_padding=args.recompile_padding,
+            zip_results=args.zip,
+            deflate_zip=args.zip_deflate,
+            save_single_representations=args.save_single_representations,
+            save_pair_representations=args.save_pair_representations,
+            use_dropout=args.use_dropout,
+            max_seq=args.max_seq,
+            max_extra_seq=args.max_extra_seq,
+            max_msa=args.max_msa,
+            use_cluster_profile=not args.disable_cluster_profile,
+            use_gpu_relax = args.use_gpu_relax,
+            save_all=args.save_all,
+            save_recycles=args.save_recycles,
+            saved_template_paths = args.saved_template_features_path,
+            saved_unpaired_msa_paths = args.saved_unpaired_msa_path,
+            n_parallel_msa=args.n_parallel_msa,
+            n_parallel_msa_jobs=args.n_parallel_msa_jobs,
+            max_msa_server_searches=args.max_msa_server_searches,
+            use_pad_buckets=not args.disable_pad_buckets,
+            save_distogram=args.save_distogram,
+            matmul_precision=args.matmul_precision,
+            config_filename=config_filename,
+        )
+
+    run_input(args.input, args.results)
+    if args.server is not None:
+        serve_jobs(args.server, run_input)
 
 if __name__ == "__main__":
     main()
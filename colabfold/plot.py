@@ -21,7 +21,7 @@ def plot_predicted_alignment_error(
     plt.close()
 
 
-def plot_msa_v3(feature_dict, sort_lines=True, dpi=300, line_thickness=0.5):
+def msa_v3_lines(feature_dict, sort_lines=True):
     seq = feature_dict["msa"][0]
     if "asym_id" in feature_dict:
         Ls = [0]
@@ -63,35 +63,55 @@ def plot_msa_v3(feature_dict, sort_lines=True, dpi=300, line_thickness=0.5):
     
     Nn = np.cumsum(np.append(0, Nn))
     lines = np.concatenate(lines, 0)
-    
+    return lines, Ln, Nn
+
+
+def plot_msa_v3(feature_dict, sort_lines=True, dpi=300, line_thickness=0.5):
+    lines, Ln, Nn = msa_v3_lines(feature_dict, sort_lines)
     plt.figure(figsize=(8, 5), dpi=dpi)
-    plt.imshow(lines,
-               interpolation='nearest', aspect='auto',
-               cmap="rainbow_r", vmin=0, vmax=1, origin='lower',
-               extent=(0, lines.shape[1], 0, lines.shape[0]))
+    draw_msa_v3(plt.gca(), lines, Ln, Nn, line_thickness)
+    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
+    
+    return plt
+
+
+def draw_msa_v3(ax, lines, Ln, Nn, line_thickness):
+    ax.imshow(lines,
+              interpolation='nearest', aspect='auto',
+              cmap="rainbow_r", vmin=0, vmax=1, origin='lower',
+              extent=(0, lines.shape[1], 0, lines.shape[0]))
 
     # Hide axes and other elements
-    plt.gca().axis('off')
-    plt.gca().xaxis.set_visible(False)
-    plt.gca().yaxis.set_visible(False)
-    plt.gca().spines['top'].set_visible(False)
-    plt.gca().spines['right'].set_visible(False)
-    plt.gca().spines['bottom'].set_visible(False)
-    plt.gca().spines['left'].set_visible(False)
-    plt.gca().set_frame_on(False)
+    ax.axis('off')
+    ax.xaxis.set_visible(False)
+    ax.yaxis.set_visible(False)
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.spines['bottom'].set_visible(False)
+    ax.spines['left'].set_visible(False)
+    ax.set_frame_on(False)
 
     # Adjust line thickness
     for i in Ln[1:-1]:
-        plt.plot([i, i], [0, lines.shape[0]], color="black", linewidth=line_thickness)
+        ax.plot([i, i], [0, lines.shape[0]], color="black", linewidth=line_thickness)
     for j in Nn[1:-1]:
-        plt.plot([0, lines.shape[1]], [j, j], color="black", linewidth=line_thickness)
+        ax.plot([0, lines.shape[1]], [j, j], color="black", linewidth=line_thickness)
 
-    plt.plot((np.isnan(lines) == False).sum(0), color='black', linewidth=line_thickness)
+    ax.plot((np.isnan(lines) == False).sum(0), color='black', linewidth=line_thickness)
 
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-    
-    return plt
 
+def save_msa_plot_v3(feature_dict, filename, sort_lines=True, dpi=300, line_thickness=0.5):
+    """plot_msa_v3 written straight to a file. the figure is not registered with pyplot,
+    so it can be drawn on a worker thread while the main thread keeps using pyplot"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    lines, Ln, Nn = msa_v3_lines(feature_dict, sort_lines)
+    fig = Figure(figsize=(8, 5), dpi=dpi)
+    FigureCanvasAgg(fig)
+    draw_msa_v3(fig.add_subplot(), lines, Ln, Nn, line_thickness)
+    fig.subplots_adjust(left=0, right=1, top=1, bottom=0)
+    fig.savefig(filename, bbox_inches='tight')
 
 
 def plot_msa_v2(feature_dict, sort_lines=True, dpi=100):
@@ -1,11 +1,16 @@
 import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from alphafold.common import protein, residue_constants
 from argparse import ArgumentParser
 from datetime import datetime
 
 def patch_openmm():
     from simtk.openmm import app
-    from simtk.unit import nanometers, sqrt
+    from simtk.unit import nanometers
+
+    if getattr(app.Topology.createDisulfideBonds, "_colabfold_patched", False):
+        return
 
     # applied https://raw.githubusercontent.com/deepmind/alphafold/main/docker/openmm.patch
     # to OpenMM 7.5.1 (see PR https://github.com/openmm/openmm/pull/3203)
@@ -13,56 +18,64 @@ def patch_openmm():
     # OpenMM is licensed under MIT and LGPL
     # fmt: off
     def createDisulfideBonds(self, positions):
-        def isCyx(res):
+        # SG atoms that already have a di-sulfide bond, used to prevent multiple
+        # di-sulfide bonds from being assigned to a given atom.
+        disulfideBonded = set()
+        for b in self._bonds:
+            if b[0].name == 'SG' and b[1].name == 'SG':
+                disulfideBonded.update((b[0], b[1]))
+
+        # the SG atom of every CYX residue, the atom names of each residue are listed once
+        sgs = []
+        for res in self.residues():
+            if res.name != 'CYS':
+                continue
             names = [atom.name for atom in res._atoms]
-            return 'SG' in names and 'HG' not in names
-        # This function is used to prevent multiple di-sulfide bonds from being
-        # assigned to a given atom.
-        def isDisulfideBonded(atom):
-            for b in self._bonds:
-                if (atom in b and b[0].name == 'SG' and
-                    b[1].name == 'SG'):
-                    return True
-
-            return False
-
-        cyx = [res for res in self.residues() if res.name == 'CYS' and isCyx(res)]
-        atomNames = [[atom.name for atom in res._atoms] for res in cyx]
-        for i in range(len(cyx)):
-            sg1 = cyx[i]._atoms[atomNames[i].index('SG')]
-            pos1 = positions[sg1.index]
-            candidate_distance, candidate_atom = 0.3*nanometers, None
-            for j in range(i):
-                sg2 = cyx[j]._atoms[atomNames[j].index('SG')]
-                pos2 = positions[sg2.index]
-                delta = [x-y for (x,y) in zip(pos1, pos2)]
-                distance = sqrt(delta[0]*delta[0] + delta[1]*delta[1] + delta[2]*delta[2])
-                if distance < candidate_distance and not isDisulfideBonded(sg2):
-                    candidate_distance = distance
-                    candidate_atom = sg2
-            # Assign bond to closest pair.
-            if candidate_atom:
+            if 'SG' in names and 'HG' not in names:
+                sgs.append(res._atoms[names.index('SG')])
+        if not sgs:
+            return
+        coords = np.array([positions[sg.index].value_in_unit(nanometers) for sg in sgs], dtype=np.float64)
+        for i, sg1 in enumerate(sgs):
+            # the distances to all earlier SG atoms at once instead of unit arithmetic per pair,
+            # one row at a time so the memory stays linear in the number of cysteines
+            delta = coords[i] - coords[:i]
+            distances = np.sqrt(delta[:, 0]*delta[:, 0] + delta[:, 1]*delta[:, 1] + delta[:, 2]*delta[:, 2])
+            candidates = [j for j in np.flatnonzero(distances < 0.3) if sgs[j] not in disulfideBonded]
+            # Assign bond to closest pair, the first one on ties.
+            if candidates:
+                candidate_atom = sgs[min(candidates, key=distances.__getitem__)]
                 self.addBond(sg1, candidate_atom)
+                disulfideBonded.update((sg1, candidate_atom))
     # fmt: on
+    createDisulfideBonds._colabfold_patched = True
     app.Topology.createDisulfideBonds = createDisulfideBonds
 
 
+def openmm_cuda_available():
+    # whether openmm can use a CUDA device, used when the relax device is not chosen explicitly
+    try:
+        from simtk.openmm import Platform
+        Platform.getPlatformByName("CUDA")
+        return True
+    except Exception:
+        return False
+
+
 def relax_pdb(pdb_filename, use_gpu=True):
 
     print(f"working on {pdb_filename}")
 
-    if "relax" not in dir():
-        patch_openmm()
-        from alphafold.common import residue_constants
-        from alphafold.relax import relax
+    # openmm and the alphafold relax module are only imported when relaxing, the patch is applied once
+    patch_openmm()
+    from alphafold.relax import relax
 
-    if not os.path.exists(pdb_filename):
+    try:
+        with open(pdb_filename, 'r') as f:
+            pdb_text = f.read()
+    except FileNotFoundError:
         return ''
 
-    pdb_text = None
-    with open(pdb_filename, 'r') as f:
-        pdb_text = f.read()
-
     pdb_obj = protein.from_pdb_string(pdb_text)
     
     current_time = datetime.now()
@@ -85,21 +98,58 @@ def relax_pdb(pdb_filename, use_gpu=True):
     return relaxed_pdb_lines
 
 
-def run(pdb_dir, result_dir, use_gpu_relax):
+def init_relax_worker():
+    # the workers each minimize one structure, openmm's own cpu threads would oversubscribe the cores
+    os.environ.setdefault("OPENMM_CPU_THREADS", "1")
+
+
+def write_relaxed_pdb(result_dir, pdb_file, pdb_lines):
+    output_pdb_filename = os.path.join(result_dir, pdb_file + '_relaxed.pdb')
+    # renamed into place when complete, an interrupted run never leaves an output that would be skipped
+    tmp_filename = f"{output_pdb_filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, 'w') as f:
+        f.write(pdb_lines)
+    os.replace(tmp_filename, output_pdb_filename)
+
+
+def run(pdb_dir, result_dir, use_gpu_relax=None, max_workers=None, keep_existing_results=True):
 
     print(f"Working on PDB files in folder {pdb_dir} and outputting to {result_dir}")
+    if use_gpu_relax is None:
+        use_gpu_relax = openmm_cuda_available()
     print(f"Using {'GPU' if use_gpu_relax else 'CPU'}")
 
     if not os.path.exists(result_dir):
         os.makedirs(result_dir)
 
-    pdb_files = [file for file in os.listdir(pdb_dir) if file.endswith(".pdb")]
-    for pdb_file in pdb_files:
-         input_pdb = os.path.join(pdb_dir, pdb_file)
-         pdb_lines = relax_pdb(input_pdb, use_gpu=use_gpu_relax)
-         output_pdb_filename = os.path.join(result_dir, pdb_file + '_relaxed.pdb')
-         with open(output_pdb_filename, 'w') as f:
-            f.write(pdb_lines)
+    # the directory entries carry their type, so no stat per file is needed to skip directories
+    with os.scandir(pdb_dir) as entries:
+        pdb_files = [entry for entry in entries if entry.name.endswith(".pdb") and entry.is_file()]
+    if keep_existing_results:
+        # one listing of the results instead of one existence check per input
+        existing = set(os.listdir(result_dir))
+        relaxed_files = [pdb_file for pdb_file in pdb_files if pdb_file.name + '_relaxed.pdb' in existing]
+        for pdb_file in relaxed_files:
+            print(f"Skipping {pdb_file.name} (already relaxed)")
+        pdb_files = [pdb_file for pdb_file in pdb_files if pdb_file.name + '_relaxed.pdb' not in existing]
+    if max_workers is None:
+        # a single gpu relaxes one structure at a time, on cpu every core gets its own structure
+        max_workers = 1 if use_gpu_relax else (os.cpu_count() or 1)
+    max_workers = min(max_workers, len(pdb_files))
+
+    if max_workers <= 1:
+        for pdb_file in pdb_files:
+            pdb_lines = relax_pdb(pdb_file.path, use_gpu=use_gpu_relax)
+            write_relaxed_pdb(result_dir, pdb_file.name, pdb_lines)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init_relax_worker) as executor:
+        futures = {
+            executor.submit(relax_pdb, pdb_file.path, use_gpu_relax): pdb_file.name
+            for pdb_file in pdb_files
+        }
+        for future in as_completed(futures):
+            write_relaxed_pdb(result_dir, futures[future], future.result())
 
 def main():
     parser = ArgumentParser()
@@ -109,9 +159,26 @@ def main():
     )
     parser.add_argument("results", help="Directory to write the results to")
     parser.add_argument("--use-gpu",
+        default=None,
+        action="store_true",
+        help="run amber on GPU instead of CPU. By default the GPU is used when openmm finds a CUDA device",
+    )
+    parser.add_argument("--use-cpu",
+        dest="use_gpu",
+        default=None,
+        action="store_false",
+        help="run amber on CPU even if a CUDA device is available",
+    )
+    parser.add_argument("--max-workers",
+        default=None,
+        type=int,
+        help="Number of PDB files relaxed in parallel processes. "
+        "Defaults to the number of CPU cores, or 1 with --use-gpu",
+    )
+    parser.add_argument("--overwrite-existing-results",
         default=False,
         action="store_true",
-        help="run amber on GPU instead of CPU",
+        help="Relax all PDB files again, instead of skipping those with a relaxed file in the results",
     )
     args = parser.parse_args()
 
@@ -119,6 +186,8 @@ def main():
         pdb_dir=args.input,
         result_dir=args.results,
         use_gpu_relax=args.use_gpu,
+        max_workers=args.max_workers,
+        keep_existing_results=not args.overwrite_existing_results,
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,37 @@
+from pathlib import Path
+from typing import List, Tuple
+
+from alphafold.common import residue_constants
+from Bio.PDB import MMCIFParser
+
+# only biopython and the residue constants are imported here: this module is the target of the
+# mk_hhsearch_db process pool workers, which would otherwise import all of colabfold.batch (and jax)
+
+# biopython parsers reset their state on every get_structure call, so one instance per process is reused
+_MMCIF_PARSER = MMCIFParser(QUIET=True)
+# bound once, parse_cif_chains looks up every residue of every template
+_RESNAME_GET = residue_constants.restype_3to1.get
+
+
+def parse_cif_chains(cif_file: Path) -> List[Tuple[str, str]]:
+    """returns the (name, one letter sequence) of every chain in a single model cif file"""
+    structure = _MMCIF_PARSER.get_structure("none", str(cif_file))
+    models = list(structure.get_models())
+    if len(models) != 1:
+        raise ValueError(
+            f"Only single model PDBs are supported. Found {len(models)} models."
+        )
+    model = models[0]
+    chains = []
+    for chain in model:
+        resnames = []
+        for res in chain:
+            if res.id[2] != " ":
+                raise ValueError(
+                    f"PDB contains an insertion code at chain {chain.id} and residue "
+                    f"index {res.id[1]}. These are not supported."
+                )
+            resnames.append(res.resname)
+        sequence = "".join([_RESNAME_GET(resname, "X") for resname in resnames])
+        chains.append((f"{cif_file.stem}_{chain.id}", sequence))
+    return chains
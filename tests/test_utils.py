@@ -1,6 +1,22 @@
+import json
+
+import numpy as np
 import pytest
 
-from colabfold.batch import get_queries, convert_pdb_to_mmcif, validate_and_fix_mmcif
+from colabfold.batch import (
+    get_queries,
+    convert_pdb_to_mmcif,
+    validate_and_fix_mmcif,
+    crop_msa,
+    aa_seq_to_id,
+    parse_chain_regions,
+    get_msa_query_sequence,
+    bucket_pad_len,
+    is_out_of_memory,
+    scores_to_json,
+    array_to_json,
+    split_a3m_row,
+)
 
 
 def test_get_queries_fasta_dir(pytestconfig, caplog):
@@ -37,6 +53,20 @@ def test_get_queries_csv(pytestconfig, caplog, tmp_path):
     assert caplog.messages == []
 
 
+def test_get_queries_sort_by_bucket(tmp_path):
+    input_csv = tmp_path.joinpath("input.csv")
+    input_csv.write_text(
+        "id,sequence\n"
+        f"long,{'A' * 200}\n"
+        f"short_b,{'C' * 20}\n"
+        f"short_a,{'D' * 10}\n"
+    )
+    queries, is_complex = get_queries(input_csv, sort_queries_by="bucket")
+
+    assert [jobname for jobname, _, _ in queries] == ["short_b", "short_a", "long"]
+    assert not is_complex
+
+
 def test_a3m_input(pytestconfig, caplog, tmp_path):
     queries, is_complex = get_queries(pytestconfig.rootpath.joinpath("test-data/a3m"))
 
@@ -138,3 +168,82 @@ def test_convert_pdb_to_mmcif_parse_with_alphafold(pytestconfig, tmp_path):
     )
 
     assert len(parsing_result.errors) == 0
+
+
+def test_crop_msa():
+    msa = ">101\nMKLVabcE\n>102\n--LVE\n>103\n-K---\n"
+    assert crop_msa(msa, 3, 4) == ">101\nLV\n>102\nLV"
+    assert crop_msa(msa, 3, 4, drop_empty=False) == ">101\nLV\n>102\nLV\n>103\n--"
+
+
+def test_crop_msa_file(tmp_path):
+    msa_file = tmp_path.joinpath("msa.a3m")
+    msa_file.write_text(">101\nMKLVabcE\n>102\n--LVE\n>103\n-K---\n")
+    assert crop_msa(msa_file, 3, 4) == ">101\nLV\n>102\nLV"
+
+
+def test_get_msa_query_sequence():
+    assert get_msa_query_sequence(">101\nMKLVE\n>102\n--LVE\n") == "MKLVE"
+    assert get_msa_query_sequence(">101\nMKLVE") == "MKLVE"
+    assert get_msa_query_sequence("") == ""
+
+
+def test_aa_seq_to_id():
+    # must stay stable, it names the files in the template and msa stores
+    assert aa_seq_to_id("YYDPETGTWY") == "6c55933ef013c56ca7965385a9ae3ccf"
+
+
+def test_parse_chain_regions():
+    jobname = "DPOLQ_HUMAN.1-500.__MSH3_HUMAN__1637aa"
+    assert parse_chain_regions(jobname, (1000, 800)) == (True, ((1, 500), (1, -1)))
+    # region runs past the end of the chain
+    assert parse_chain_regions(jobname, (400, 800)) == (False, ())
+    # a dot without a region does not crop
+    assert parse_chain_regions("A.fasta__B__x", (10, 10)) == (True, ((1, -1), (1, -1)))
+
+
+def test_bucket_pad_len():
+    assert bucket_pad_len(10) == 128
+    assert bucket_pad_len(128) == 128
+    assert bucket_pad_len(129) == 256
+    assert bucket_pad_len(512) == 512
+    # beyond the ladder: multiples of 128, padded by at most 10%
+    assert bucket_pad_len(600) == 640
+    assert bucket_pad_len(513) == 565
+    assert bucket_pad_len(1025) == 1128
+    assert bucket_pad_len(2049) == 2176
+
+
+def test_is_out_of_memory():
+    assert is_out_of_memory(RuntimeError("RESOURCE_EXHAUSTED: Out of memory while trying to allocate 1.2GiB"))
+    assert is_out_of_memory(RuntimeError("CUDA error: out of memory"))
+    assert not is_out_of_memory(RuntimeError("INTERNAL: cuDNN error"))
+
+
+def test_scores_to_json():
+    scores = {
+        "id": "abc",
+        "max_pae": 31.75,
+        "pae": np.array([[0, 12], [3, 31]], dtype=np.int16),
+        "ptm": 0.87,
+    }
+    assert json.loads(scores_to_json(scores)) == {
+        "id": "abc",
+        "max_pae": 31.75,
+        "pae": [[0, 12], [3, 31]],
+        "ptm": 0.87,
+    }
+
+
+def test_array_to_json():
+    dist = np.array([[[90, 10], [0, 100]], [[5, 95], [50, 50]]], dtype=np.int8)
+    assert array_to_json(dist) == b"[[[90,10],[0,100]],[[5,95],[50,50]]]"
+    assert array_to_json(dist.max(axis=-1)) == b"[[90,100],[95,50]]"
+
+
+def test_split_a3m_row():
+    # insertions in front of a match column belong to its chain, the ones after the last column are dropped
+    assert split_a3m_row("AaC--bbG-c", [2, 2, 2]) == (
+        ["AaC", "--", "bbG-"],
+        [True, False, True],
+    )